@@ -0,0 +1,130 @@
+""" Response compression for the mock API.
+
+Starlette's GZipMiddleware only supports gzip, so this middleware also supports brotli, which gives
+smaller JSON responses for about the same CPU time.
+"""
+import gzip
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """ Returns "br" or "gzip" if the client accepts it (brotli preferred), otherwise None
+
+    Args:
+        accept_encoding: value of the Accept-Encoding request header, e.g. "gzip, deflate, br"
+    """
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip())
+    for encoding in ("br", "gzip"):
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+class CompressionMiddleware:
+    """ ASGI middleware that compresses responses with brotli or gzip, as accepted by the client.
+
+    - Responses smaller than minimum_size bytes are not compressed, the saving is too small to be
+      worth the CPU time.
+    - Streaming responses (text/event-stream) and responses that are already encoded are sent
+      unchanged.
+    - Responses with an ETag are versioned, so their compressed bodies are cached (keyed by the
+      URL path and query, ETag and encoding) and reused until the version changes. A SHA-256 hash
+      of the body is also compared, so a stale ETag does not return the wrong data.
+
+    Attributes:
+        minimum_size: smallest response body, in bytes, to compress
+        gzip_level: gzip compression level, 1 (fastest) to 9 (smallest)
+        brotli_quality: brotli quality, 0 (fastest) to 11 (smallest)
+        cache_size: maximum number of compressed bodies to cache
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 500, gzip_level: int = 6,
+                 brotli_quality: int = 4, cache_size: int = 128):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, bytes, str, str], Tuple[bytes, bytes]]" = OrderedDict()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+        passthrough = False
+        body = []
+
+        async def _send(message: Message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                passthrough = (
+                    "content-encoding" in headers
+                    or headers.get("content-type", "").startswith("text/event-stream")
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            data = b"".join(body)
+            headers = MutableHeaders(raw=start_message["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            if len(data) >= self.minimum_size:
+                etag = headers.get("etag")
+                key = (scope["path"], scope.get("query_string", b""), etag, encoding) if etag else None
+                data = self._compress(data, encoding, key)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(data))
+            await send(start_message)
+            await send({"type": "http.response.body", "body": data})
+
+        await self.app(scope, receive, _send)
+
+    def _compress(self, data: bytes, encoding: str, key: Optional[Tuple]) -> bytes:
+        """ Returns the compressed data, from the cache if there is a cache key
+
+        Args:
+            data: the response body
+            encoding: "br" or "gzip"
+            key: (path, query string, ETag, encoding) for a versioned response, None to not cache
+        """
+        digest = hashlib.sha256(data).digest() if key else None
+        if key:
+            cached = self._cache.get(key)
+            if cached and cached[0] == digest:
+                self._cache.move_to_end(key)
+                return cached[1]
+        if encoding == "br":
+            compressed = brotli.compress(data, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(data, compresslevel=self.gzip_level)
+        if key:
+            self._cache[key] = (digest, compressed)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return compressed
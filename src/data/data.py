@@ -1,69 +1,448 @@
+import csv
+import hashlib
 import json
+import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import pandas as pd
 
+# Seconds a connection waits for another process to finish writing before giving up
+BUSY_TIMEOUT = 5.0
+# Number of times add_row tries again if the database is still locked after BUSY_TIMEOUT
+WRITE_RETRIES = 3
+# Most ids in one query of get_rows_by_ids, well under SQLite's limit on the number of ? parameters
+IDS_PER_QUERY = 500
+# Most levels of related tables in an expand parameter, e.g. "games_host.host.country" is 3
+MAX_EXPAND_DEPTH = 3
+# check_for_changes() sends an event for each row added by another process, up to this many per
+# table. If more rows were added (e.g. by a bulk load) listeners are told once, with row None.
+MAX_CHANGE_EVENTS = 100
+
 
 class ParalympicsData:
     """ Class representing the paralympics data in JSON format.
 
     Each method returns all rows from a table as JSON.
 
+    In snapshot mode the database is copied into memory when the class is created and all reads
+    use the in-memory copy, so no reads go to disk. Writes (add_row) go to the database file and
+    the new row is then copied into the snapshot. Changes made to the file by other programs are
+    not seen until refresh_snapshot() is called.
+
+    Other code can be told about changes by adding a listener with add_listener(). Each table
+    also has a version number that goes up by one whenever a row is added to it.
+
+    More than one process can use the same database file, e.g. several API workers. Each has its
+    own ParalympicsData, connections and snapshot. To keep writes safe:
+
+    - wal=True switches the database to WAL journal mode, so reads are not blocked by a write
+    - add_row takes the write lock at the start of its transaction, waits up to BUSY_TIMEOUT for
+      other writers, and tries again up to WRITE_RETRIES times if the database is still locked
+
+    Rows added by other processes are found by calling check_for_changes() regularly. It is cheap
+    when nothing has changed. Other changes (rows updated or deleted) are noticed, but not which
+    rows or tables changed, so they are reported as a change to every table.
+
+    The list of tables and their columns are read once and cached. Call refresh_tables() to read
+    them again, e.g. after a table has been added to the database.
+
+    Rows can be returned with their related rows nested in them, using the expand argument of
+    get_table_as_json, get_row_by_id and get_rows_by_ids. The relations come from the foreign keys,
+    see _get_relations.
+
     Attributes:
         database_file: path to the database file
         tables: list of table names from the database
+        snapshot: True if reads use an in-memory copy of the database
+        wal: True if the database is used in WAL journal mode
+        versions: dict of table name to version number, starting at 0
 
     Methods:
         get_table_as_json(self, table_name): Gets the data from the specified table and returns it as JSON
         get_all_data(self): Gets data from joined tables and returns it as JSON
         get_row_by_id(self, row_id): Gets the data from the specified row and returns it as JSON
+        get_rows_by_ids(self, table_name, ids): Gets several rows by their ids in one query
         add_row(self, row_id): Adds a new row to the table
         search_table(self, table_name, filters): Gets rows based on search criteria in any column
+        refresh_snapshot(self): Copies the database file into the in-memory snapshot again
+        add_listener(self, listener): Registers a function to call when a row is added
+        enable_wal(self): Switches the database file to WAL journal mode
+        check_for_changes(self): Finds rows added by other processes and tells the listeners
+        refresh_tables(self, max_age): Reads the list of tables from the database again
+        get_relations(self, table_name): Gets the names of the related tables that can be expanded
+        expand_tables(self, table_name, expand): Gets the tables used by an expand parameter
 
     """
 
-    def __init__(self):
-        self.database_file = Path(__file__).parent.joinpath("paralympics.db")
+    def __init__(self, snapshot: bool = False, wal: bool = False,
+                 database_file: Optional[Path] = None):
+        self.database_file = Path(database_file or Path(__file__).parent.joinpath("paralympics.db"))
         if not self.database_file.exists():
             raise FileNotFoundError(f"Database file not found: {self.database_file}")
         self.tables = []
+        # PRAGMA table_info rows for each table, see _table_info
+        self._table_info: Dict[str, List[tuple]] = {}
+        # time.monotonic() when the list of tables was last read, see refresh_tables
+        self._tables_read_at = time.monotonic()
+        # Relations of each table found from the foreign keys, see _get_relations
+        self._relations: Dict[str, Dict[str, Tuple[str, str, str, bool]]] = {}
+        self.snapshot = snapshot
+        self.wal = wal
+        if wal:
+            self.enable_wal()
+        self._snapshot_conn: Optional[sqlite3.Connection] = None
+        # The snapshot connection is shared by all threads, so only one may use it at a time
+        self._snapshot_lock = threading.RLock()
+        if snapshot:
+            self.refresh_snapshot()
         try:
-            conn = sqlite3.connect(self.database_file)
-            with conn:
-                cur = conn.cursor()
-                cur.execute(
-                    "SELECT name FROM sqlite_master WHERE type='table' AND name != 'sqlite_master'"
-                )
-                self.tables = [row[0] for row in cur.fetchall()]
+            with self._connect() as conn:
+                self.tables = self._read_tables(conn)
         except Exception as e:
             raise RuntimeError(f"Error querying database tables: {e}") from e
+        self.versions: Dict[str, int] = {t: 0 for t in self.tables}
+        self._listeners: List[Callable[[str, Dict], None]] = []
 
-    def _get_columns(self, table_name: str) -> List[str]:
-        conn = sqlite3.connect(self.database_file)
+        # Used by check_for_changes. Held while writing and checking so each new row is only
+        # reported once.
+        self._watch_lock = threading.Lock()
+        self._watch_conn = sqlite3.connect(self.database_file, timeout=BUSY_TIMEOUT,
+                                           check_same_thread=False)
         try:
-            cur = conn.cursor()
-            cur.execute(f"PRAGMA table_info('{table_name}')")
-            cols = [row[1] for row in cur.fetchall()]  # the second column is 'name'
-            return cols
+            self._data_version = self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+            self._max_rowids = {t: self._max_rowid(t) for t in self.tables}
+        except Exception as e:
+            raise RuntimeError(f"Error querying database tables: {e}") from e
+        # Rows added by this instance that check_for_changes has not seen yet
+        self._own_rowids: Dict[str, Set[int]] = {t: set() for t in self.tables}
+
+    def add_listener(self, listener: Callable[[str, Dict], None]):
+        """ Registers a function to be called after a row is added to a table
+
+        Args:
+            listener: function called with the table name and the new row (as returned by add_row)
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, table_name: str, row: Dict):
+        self.versions[table_name] = self.versions.get(table_name, 0) + 1
+        for listener in self._listeners:
+            listener(table_name, row)
+
+    def enable_wal(self):
+        """ Switches the database file to WAL (write-ahead log) journal mode
+
+        In WAL mode readers do not block the writer and the writer does not block readers, which
+        matters when several processes use the database. The mode is saved in the database file,
+        so it stays in WAL mode for every program that uses it.
+
+        Raises:
+            RuntimeError: if the journal mode could not be changed
+        """
+        conn = sqlite3.connect(self.database_file, timeout=BUSY_TIMEOUT)
+        try:
+            mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        except Exception as e:
+            raise RuntimeError(f"Error setting journal mode: {e}") from e
         finally:
             conn.close()
+        if mode.lower() != "wal":
+            raise RuntimeError(f"Error setting journal mode: database is in {mode} mode")
 
-    def _get_pk_column(self, table_name: str) -> Optional[str]:
+    def _max_rowid(self, table_name: str) -> int:
+        row = self._watch_conn.execute(f"SELECT max(rowid) FROM '{table_name}'").fetchone()
+        return row[0] or 0
+
+    def check_for_changes(self) -> List[str]:
+        """ Finds rows added to the database file by other processes, e.g. other API workers
+
+        Uses PRAGMA data_version, which changes when another connection commits a change, so this
+        only queries the tables when something has changed. For each new row the table's version
+        is increased, the row is copied into the snapshot (in snapshot mode) and the listeners
+        are told, as for add_row.
+
+        If the database changed but no rows were added after the last row of any table (e.g. rows
+        were updated or deleted, or load_seed_files updated rows), the changed rows can't be found
+        cheaply. Every table is then reported as changed, with None as the row, and in snapshot
+        mode the whole snapshot is copied again.
+
+        Returns:
+            table_names: the tables that had rows added (or possibly changed) by other processes
+
+        Raises:
+            RuntimeError: if the database could not be queried
+        """
+        changed = []
+        with self._watch_lock:
+            try:
+                data_version = self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+                if data_version == self._data_version:
+                    return changed
+                self._data_version = data_version
+                rows_added = False
+                for table_name in self.tables:
+                    max_rowid = self._max_rowid(table_name)
+                    last_rowid = self._max_rowids.get(table_name, 0)
+                    if max_rowid == last_rowid:
+                        continue
+                    rows_added = rows_added or max_rowid > last_rowid  # lower if the last rows were deleted
+                    self._max_rowids[table_name] = max_rowid
+                    own_rowids = self._own_rowids.setdefault(table_name, set())
+                    cur = self._watch_conn.execute(
+                        f"SELECT rowid, * FROM '{table_name}' WHERE rowid > ? AND rowid <= ? "
+                        f"ORDER BY rowid LIMIT {MAX_CHANGE_EVENTS + len(own_rowids) + 1}",
+                        (last_rowid, max_rowid),
+                    )
+                    columns = [d[0] for d in cur.description[1:]]
+                    new_rows = [r for r in cur.fetchall() if r[0] not in own_rowids]
+                    own_rowids.difference_update([r for r in own_rowids if r <= max_rowid])
+                    if not new_rows:
+                        continue
+                    changed.append(table_name)
+                    if len(new_rows) > MAX_CHANGE_EVENTS:
+                        if self.snapshot:
+                            self.refresh_snapshot()
+                        self._notify(table_name, None)
+                        continue
+                    for row in new_rows:
+                        if self.snapshot:
+                            self._copy_row_to_snapshot(self._watch_conn, table_name, row[0])
+                        self._notify(table_name, dict(zip(columns, row[1:])))
+                if not rows_added:
+                    # Nothing explains the change, so rows were changed in place or deleted
+                    if self.snapshot:
+                        self.refresh_snapshot()
+                    changed = list(self.tables)
+                    for table_name in changed:
+                        self._notify(table_name, None)
+            except Exception as e:
+                raise RuntimeError(f"Error checking for changes: {e}") from e
+        return changed
+
+    @staticmethod
+    def _read_tables(conn: sqlite3.Connection) -> List[str]:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'sqlite_master'")
+        return [row[0] for row in cur.fetchall()]
+
+    def refresh_tables(self, max_age: float = 0) -> List[str]:
+        """ Reads the list of tables from the database file again
+
+        Tables added since the class was created can then be used. If the tables have changed the
+        cached columns and relations are read again when next needed, and in snapshot mode the
+        snapshot is copied again if there are new tables.
+
+        Args:
+            max_age: seconds, if the tables were read less than this long ago the cached list is
+                returned without querying the database, e.g. to limit the queries caused by
+                requests for tables that don't exist
+
+        Returns:
+            tables: the table names
+
+        Raises:
+            RuntimeError: if the database could not be queried
+        """
+        if time.monotonic() - self._tables_read_at < max_age:
+            return self.tables
+        with self._watch_lock:
+            self._tables_read_at = time.monotonic()
+            try:
+                tables = self._read_tables(self._watch_conn)
+            except Exception as e:
+                raise RuntimeError(f"Error querying database tables: {e}") from e
+            if set(tables) == set(self.tables):
+                # Nothing was added or removed, so the cached columns and relations are still correct
+                return self.tables
+            try:
+                new_tables = [t for t in tables if t not in self.tables]
+                for table_name in new_tables:
+                    self.versions.setdefault(table_name, 0)
+                    self._max_rowids[table_name] = self._max_rowid(table_name)
+                    self._own_rowids.setdefault(table_name, set())
+            except Exception as e:
+                raise RuntimeError(f"Error querying database tables: {e}") from e
+            if new_tables and self.snapshot:
+                self.refresh_snapshot()
+            self._table_info = {}
+            self._relations = {}
+            self.tables = tables
+        return tables
+
+    def refresh_snapshot(self):
+        """ Copies the whole database file into the in-memory snapshot using the SQLite backup API """
+        snapshot_conn = sqlite3.connect(":memory:", check_same_thread=False)
+        disk_conn = sqlite3.connect(self.database_file)
+        try:
+            disk_conn.backup(snapshot_conn)
+        finally:
+            disk_conn.close()
+        with self._snapshot_lock:
+            old_conn, self._snapshot_conn = self._snapshot_conn, snapshot_conn
+        if old_conn:
+            old_conn.close()
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """ Yields a connection to read from: the snapshot in snapshot mode, else the database file """
+        if self.snapshot:
+            with self._snapshot_lock:
+                yield self._snapshot_conn
+            return
         conn = sqlite3.connect(self.database_file)
         try:
-            cur = conn.cursor()
-            cur.execute(f"PRAGMA table_info('{table_name}')")
-            for row in cur.fetchall():
-                # row format: (cid, name, type, notnull, dflt_value, pk)
-                if row[5]:  # pk > 0
-                    return row[1]
-            return None
+            yield conn
         finally:
             conn.close()
 
-    def get_table_as_json(self, table_name):
+    def _get_table_info(self, table_name: str) -> List[tuple]:
+        """ Returns the PRAGMA table_info rows for a table, read once and then cached """
+        info = self._table_info.get(table_name)
+        if info is None:
+            with self._connect() as conn:
+                cur = conn.cursor()
+                cur.execute(f"PRAGMA table_info('{table_name}')")
+                info = cur.fetchall()
+            self._table_info[table_name] = info
+        return info
+
+    def _get_columns(self, table_name: str) -> List[str]:
+        return [row[1] for row in self._get_table_info(table_name)]  # the second column is 'name'
+
+    def _get_pk_column(self, table_name: str) -> Optional[str]:
+        for row in self._get_table_info(table_name):
+            # row format: (cid, name, type, notnull, dflt_value, pk)
+            if row[5]:  # pk > 0
+                return row[1]
+        return None
+
+    def _get_relations(self, table_name: str) -> Dict[str, Tuple[str, str, str, bool]]:
+        """ Returns the relations of a table that can be expanded, found from the foreign keys
+
+        Each relation is named after the other table:
+        - a foreign key in this table gives one related row, e.g. host -> "country"
+        - a foreign key in another table that refers to this table gives a list of related rows,
+          e.g. games -> "games_host"
+        If more than one foreign key links the same two tables, the first one is used.
+
+        Returns:
+            relations: dict of name to (other table, column in this table, column in the other
+                table, True if there is a list of related rows)
+        """
+        relations = self._relations.get(table_name)
+        if relations is not None:
+            return relations
+        relations = {}
+        with self._connect() as conn:
+            foreign_keys = {t: conn.execute(f"PRAGMA foreign_key_list('{t}')").fetchall()
+                            for t in self.tables}
+        # row format: (id, seq, table, from, to, on_update, on_delete, match), "to" is None if the
+        # foreign key refers to the other table's primary key
+        for fk in foreign_keys.get(table_name, []):
+            if fk[2] in self.tables:
+                relations.setdefault(fk[2], (fk[2], fk[3], fk[4] or self._get_pk_column(fk[2]), False))
+        for other, other_fks in foreign_keys.items():
+            for fk in other_fks:
+                if fk[2] == table_name:
+                    relations.setdefault(other, (other, fk[4] or self._get_pk_column(table_name), fk[3], True))
+        self._relations[table_name] = relations
+        return relations
+
+    def get_relations(self, table_name: str) -> List[str]:
+        """ Returns the names of the related tables that can be used in an expand parameter """
+        if table_name not in self.tables:
+            raise RuntimeError(f"Table {table_name} does not exist")
+        return list(self._get_relations(table_name))
+
+    @staticmethod
+    def _parse_expand(expand: str) -> Dict[str, Dict]:
+        """ Returns an expand parameter as a tree, e.g. "a.b,c" -> {"a": {"b": {}}, "c": {}} """
+        tree: Dict[str, Dict] = {}
+        for path in expand.split(","):
+            names = [name.strip() for name in path.split(".") if name.strip()]
+            if len(names) > MAX_EXPAND_DEPTH:
+                raise ValueError(f"Cannot expand {path}, at most {MAX_EXPAND_DEPTH} levels can be expanded")
+            node = tree
+            for name in names:
+                node = node.setdefault(name, {})
+        return tree
+
+    def _expand_sql(self, table_name: str, alias: str, tree: Dict[str, Dict]) -> List[Tuple[str, str]]:
+        """ Returns a correlated subquery for each relation in the tree, which returns the related
+        row (or list of rows) as JSON, including any relations nested below it in the tree.
+
+        Args:
+            table_name: the table the relations are from
+            alias: the alias of that table in the outer query
+            tree: the relations to expand, see _parse_expand
+
+        Returns:
+            subqueries: list of (relation name, SQL)
+
+        Raises:
+            ValueError: if a relation name is not one of the table's relations
+        """
+        relations = self._get_relations(table_name)
+        subqueries = []
+        for i, (name, children) in enumerate(tree.items()):
+            if name not in relations:
+                raise ValueError(f"Cannot expand {name}, the relations of {table_name} are: "
+                                 f"{', '.join(relations) or 'none'}")
+            other, column, other_column, many = relations[name]
+            other_alias = f"{alias}_{i}"
+            # json_object takes pairs of arguments: the key, as an SQL string, then the value
+            fields = [f'{_sql_string(c)}, {other_alias}."{c}"' for c in self._get_columns(other)]
+            fields += [f"{_sql_string(n)}, json({sql})"
+                       for n, sql in self._expand_sql(other, other_alias, children)]
+            row_json = f"json_object({', '.join(fields)})"
+            if many:
+                row_json = f"json_group_array({row_json})"
+            subqueries.append((name, f"(SELECT {row_json} FROM '{other}' {other_alias} "
+                                     f"WHERE {other_alias}.\"{other_column}\" = {alias}.\"{column}\")"))
+        return subqueries
+
+    def _expand_columns(self, table_name: str, expand: Optional[str]) -> Tuple[str, List[str]]:
+        """ Returns the SQL to add to the SELECT list of a query of table_name (with the alias t0) for
+        an expand parameter, and the names of the relations in the order of the columns added """
+        if not expand:
+            return "", []
+        subqueries = self._expand_sql(table_name, "t0", self._parse_expand(expand))
+        sql = "".join(f', {subquery} AS "_expand_{i}"' for i, (_, subquery) in enumerate(subqueries))
+        return sql, [name for name, _ in subqueries]
+
+    @staticmethod
+    def _add_expanded(row: Dict, names: List[str]) -> Dict:
+        """ Replaces the JSON columns added by _expand_columns with the related rows """
+        for i, name in enumerate(names):
+            value = row.pop(f"_expand_{i}")
+            row[name] = json.loads(value) if value is not None else None
+        return row
+
+    def expand_tables(self, table_name: str, expand: Optional[str]) -> List[str]:
+        """ Returns the names of the tables the rows come from when using an expand parameter
+
+        Raises:
+            ValueError: if the expand parameter is not valid for the table
+        """
+        tables = [table_name]
+        nodes = [(table_name, self._parse_expand(expand) if expand else {})]
+        while nodes:
+            name, tree = nodes.pop()
+            relations = self._get_relations(name)
+            for relation, children in tree.items():
+                if relation not in relations:
+                    raise ValueError(f"Cannot expand {relation}, the relations of {name} are: "
+                                     f"{', '.join(relations) or 'none'}")
+                tables.append(relations[relation][0])
+                nodes.append((relations[relation][0], children))
+        return list(dict.fromkeys(tables))
+
+    def get_table_as_json(self, table_name, expand: Optional[str] = None):
         """ Method to return the specified table data from the paralympics .db file.
 
         Uses sqlite3 to access and query the database
@@ -71,27 +450,29 @@ class ParalympicsData:
 
         Args:
             table_name: name of the database table
+            expand: related tables to nest in each row, separated by commas, with dots for
+                relations of those tables, e.g. "games_host.host.country,games_disability.disability"
 
         Returns:
             json_data: json format data
+
+        Raises:
+            ValueError: if expand names a relation the table does not have, or is too deep
         """
+        expand_sql, expand_names = self._expand_columns(table_name, expand)
         try:
-            conn = sqlite3.connect(self.database_file)
-            with conn:
+            with self._connect() as conn:
                 conn.row_factory = sqlite3.Row  # Returns columns by names instead of tuples
                 cur = conn.cursor()
-                sql = f"SELECT * from {table_name}"
+                sql = f"SELECT t0.*{expand_sql} from {table_name} t0"
                 cur.execute(sql)
                 rows = cur.fetchall()
                 if not rows:
                     return []
-                data = [dict(row) for row in rows]
+                data = [self._add_expanded(dict(row), expand_names) for row in rows]
                 return data
         except Exception as e:
             raise RuntimeError(f"Error querying table {table_name}: {e}") from e
-        finally:
-            if conn:
-                conn.close()
 
     def get_all_data(self):
         """ Method to return all data from the paralympics .db file.
@@ -115,8 +496,7 @@ class ParalympicsData:
             "JOIN country ON host.country_id = country.id"
         )
         try:
-            conn = sqlite3.connect(self.database_file)
-            with conn:
+            with self._connect() as conn:
                 conn.row_factory = sqlite3.Row  # Returns columns by names instead of tuples
                 cur = conn.cursor()
                 cur.execute(sql)
@@ -127,27 +507,68 @@ class ParalympicsData:
                 return data
         except Exception as e:
             raise RuntimeError(f"Error querying tables: {e}") from e
-        finally:
-            if conn:
-                conn.close()
 
-    def get_row_by_id(self, table_name: str, item_id):
+    def get_row_by_id(self, table_name: str, item_id, expand: Optional[str] = None):
         if table_name not in self.tables:
             raise RuntimeError(f"Table {table_name} does not exist")
         pk = self._get_pk_column(table_name)
-        conn = sqlite3.connect(self.database_file)
-        try:
+        expand_sql, expand_names = self._expand_columns(table_name, expand)
+        with self._connect() as conn:
             conn.row_factory = sqlite3.Row
             cur = conn.cursor()
             if pk:
-                sql = f"SELECT * FROM '{table_name}' WHERE \"{pk}\" = ?"
+                sql = f"SELECT t0.*{expand_sql} FROM '{table_name}' t0 WHERE t0.\"{pk}\" = ?"
             else:
-                sql = f"SELECT * FROM '{table_name}' WHERE rowid = ?"
+                sql = f"SELECT t0.*{expand_sql} FROM '{table_name}' t0 WHERE t0.rowid = ?"
             cur.execute(sql, (item_id,))
             row = cur.fetchone()
-            return dict(row) if row else None
-        finally:
-            conn.close()
+            return self._add_expanded(dict(row), expand_names) if row else None
+
+    def get_rows_by_ids(self, table_name: str, ids: List, expand: Optional[str] = None) -> Dict[str, List]:
+        """ Method to return several rows from a table by their primary key (or rowid).
+
+        The rows are read with one WHERE ... IN (...) query for up to IDS_PER_QUERY ids, instead of
+        a query for each id.
+
+        Args:
+            table_name: name of the database table
+            ids: the primary key values, duplicates are ignored
+            expand: related tables to nest in each row, see get_table_as_json
+
+        Returns:
+            result: dict with "rows", the rows in the same order as ids, and "missing", the ids
+                that have no row, e.g. {"rows": [{"id": 1, ...}, {"id": 3, ...}], "missing": [2]}
+
+        Raises:
+            RuntimeError: if the table does not exist or the database could not be queried
+            ValueError: if expand is not valid for the table
+        """
+        if table_name not in self.tables:
+            raise RuntimeError(f"Table {table_name} does not exist")
+        ids = list(dict.fromkeys(ids))
+        pk = self._get_pk_column(table_name)
+        key = f't0."{pk}"' if pk else "t0.rowid"
+        expand_sql, expand_names = self._expand_columns(table_name, expand)
+        found = {}
+        try:
+            with self._connect() as conn:
+                for start in range(0, len(ids), IDS_PER_QUERY):
+                    chunk = ids[start:start + IDS_PER_QUERY]
+                    placeholders = ", ".join("?" for _ in chunk)
+                    # the first column is the key, to match the rows to the ids
+                    cur = conn.execute(
+                        f"SELECT {key}, t0.*{expand_sql} FROM '{table_name}' t0 WHERE {key} IN ({placeholders})",
+                        tuple(chunk),
+                    )
+                    columns = [d[0] for d in cur.description[1:]]
+                    for row in cur.fetchall():
+                        found[row[0]] = self._add_expanded(dict(zip(columns, row[1:])), expand_names)
+        except Exception as e:
+            raise RuntimeError(f"Error querying table {table_name}: {e}") from e
+        return {
+            "rows": [found[i] for i in ids if i in found],
+            "missing": [i for i in ids if i not in found],
+        }
 
     def search_table(self, table_name: str, filters: Dict[str, str]):
         if table_name not in self.tables:
@@ -162,15 +583,12 @@ class ParalympicsData:
             where_clauses.append(f"\"{col}\" = ?")
             values.append(val)
         sql = f"SELECT * FROM '{table_name}' WHERE " + " AND ".join(where_clauses)
-        conn = sqlite3.connect(self.database_file)
-        try:
+        with self._connect() as conn:
             conn.row_factory = sqlite3.Row
             cur = conn.cursor()
             cur.execute(sql, tuple(values))
             rows = cur.fetchall()
             return [dict(r) for r in rows]
-        finally:
-            conn.close()
 
     def add_row(self, table_name: str, row: Dict):
         if table_name not in self.tables:
@@ -183,42 +601,170 @@ class ParalympicsData:
         columns = ", ".join(f"\"{c}\"" for c in data.keys())
         placeholders = ", ".join("?" for _ in data)
         sql = f"INSERT INTO '{table_name}' ({columns}) VALUES ({placeholders})"
-        conn = sqlite3.connect(self.database_file)
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, tuple(data.values()))
-            conn.commit()
-            last_id = cur.lastrowid
+        with self._watch_lock:
+            for attempt in range(WRITE_RETRIES + 1):
+                try:
+                    last_id = self._insert(table_name, sql, tuple(data.values()))
+                    break
+                except sqlite3.OperationalError as e:
+                    # Another process still has the write lock after BUSY_TIMEOUT, wait and try again
+                    if attempt == WRITE_RETRIES or "locked" not in str(e):
+                        raise
+                    time.sleep(0.1 * 2 ** attempt)
+            self._own_rowids.setdefault(table_name, set()).add(last_id)
             # return the inserted row (by primary key if available)
             pk = self._get_pk_column(table_name)
             if pk:
-                return self.get_row_by_id(table_name, last_id)
+                new_row = self.get_row_by_id(table_name, last_id)
             else:
                 # no pk, return the last inserted row via rowid
-                return self.get_row_by_id(table_name, last_id)
+                new_row = self.get_row_by_id(table_name, last_id)
+            self._notify(table_name, new_row)
+        return new_row
+
+    def _insert(self, table_name: str, sql: str, values: tuple) -> int:
+        """ Inserts a row into the database file and returns its rowid """
+        # Writes always go to the database file. isolation_level=None so the transaction is
+        # controlled by BEGIN IMMEDIATE/COMMIT, which takes the write lock at the start.
+        conn = sqlite3.connect(self.database_file, timeout=BUSY_TIMEOUT, isolation_level=None)
+        try:
+            if self.wal:
+                # In WAL mode a commit only needs to wait for the disk at checkpoints. The database
+                # can't be corrupted, but the last commits could be lost in a power cut.
+                conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                last_id = conn.execute(sql, values).lastrowid
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if self.snapshot:
+                self._copy_row_to_snapshot(conn, table_name, last_id)
         finally:
             conn.close()
+        return last_id
+
+    def _copy_row_to_snapshot(self, disk_conn: sqlite3.Connection, table_name: str, rowid: int):
+        """ Copies a row that was written to the database file into the snapshot """
+        cur = disk_conn.execute(f"SELECT rowid, * FROM '{table_name}' WHERE rowid = ?", (rowid,))
+        row = cur.fetchone()
+        if row is None:
+            return
+        # the first column is rowid, the description names it after the table's INTEGER PRIMARY
+        # KEY if it has one, so always use 'rowid' to set it
+        columns = ["rowid"] + [f"\"{d[0]}\"" for d in cur.description[1:]]
+        placeholders = ", ".join("?" for _ in columns)
+        with self._snapshot_lock:
+            self._snapshot_conn.execute(
+                f"INSERT OR REPLACE INTO '{table_name}' ({', '.join(columns)}) VALUES ({placeholders})",
+                tuple(row),
+            )
+            self._snapshot_conn.commit()
+
+
+def _sql_string(value: str) -> str:
+    """ Returns the value as an SQL string literal, e.g. it's -> 'it''s' """
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _read_event_frame(data_file: Path, cache_dir: Optional[Path] = None) -> pd.DataFrame:
+    """ Reads the .xlsx file into a DataFrame, using a cached copy when the file has not changed.
+
+    Parsing .xlsx with openpyxl is slow, so the first read saves the DataFrame as a pickle file
+    next to the .xlsx (a 'sidecar' file), or in cache_dir. The sidecar is used while the .xlsx has
+    the same modification time and size. If those change the file is hashed, and it is only parsed
+    again if the content (SHA-256 hash) has changed.
+
+    The cache is only used if it can be: if the directory is read-only (e.g. an installed package)
+    the .xlsx is parsed every time. Set PARALYMPICS_CACHE_DIR to a writable directory to use one.
+
+    NB: the sidecar is trusted. Reading a pickle file can run any code in it, so the cache
+    directory must only be writable by the user that runs this code.
+
+    Args:
+        data_file: path to the .xlsx file
+        cache_dir: directory for the sidecar files, defaults to PARALYMPICS_CACHE_DIR or, if that
+            is not set, the directory of the .xlsx file
+
+    Returns:
+        df: DataFrame with the data from the first sheet
+    """
+    cache_dir = Path(cache_dir or os.environ.get("PARALYMPICS_CACHE_DIR") or data_file.parent)
+    cache_file = cache_dir / (data_file.name + ".cache.pkl")
+    meta_file = cache_dir / (data_file.name + ".cache.json")
+    stat = data_file.stat()
+    try:
+        meta = json.loads(meta_file.read_text())
+    except (OSError, ValueError):
+        meta = {}
+
+    if cache_file.exists() and meta.get("mtime_ns") == stat.st_mtime_ns and meta.get(
+            "size") == stat.st_size:
+        try:
+            return pd.read_pickle(cache_file)
+        except Exception:  # the sidecar is only a cache, so parse the .xlsx if it can't be read
+            pass
+
+    sha256 = hashlib.sha256(data_file.read_bytes()).hexdigest()
+    df = None
+    if cache_file.exists() and meta.get("sha256") == sha256:
+        try:
+            df = pd.read_pickle(cache_file)
+        except Exception:
+            df = None
+    try:
+        if df is None:
+            df = pd.read_excel(data_file)
+            tmp_file = cache_file.with_suffix(".tmp")
+            df.to_pickle(tmp_file)
+            tmp_file.replace(cache_file)
+        meta_file.write_text(json.dumps({"mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                                         "sha256": sha256}))
+    except OSError:
+        pass  # the cache could not be written, e.g. a read-only directory, the data is still returned
+    return df
+
+
+def _iter_records(df: pd.DataFrame) -> Iterator[Dict]:
+    """ Yields each row of the DataFrame as a dict, with missing values as None """
+    columns = list(df.columns)
+    for row in df.itertuples(index=False, name=None):
+        yield {col: (None if pd.isna(val) else val) for col, val in zip(columns, row)}
 
 
 # Example of a function that gets data from an excel file and returns in JSON format
-def get_event_data():
+def get_event_data(output: str = "json"):
     """ Method to return the data from the paralympics .xlsx file.
 
     NB: This is a simplified return of all data without validation.
 
+    The .xlsx is only parsed when it changes, see _read_event_frame.
+
+    Args:
+        output: "json" for a JSON string, "dataframe" for a pandas DataFrame, or "records" for an
+            iterator that yields one dict per row (avoids building the whole JSON string)
+
     Returns:
-        json_data: json format paralympics data
+        json_data: json format paralympics data, or the DataFrame or records iterator
 
     Raises:
         RuntimeError: if the data could not be read, converted to JSON
         FileNotFoundError: if no event file was found
+        ValueError: if output is not one of "json", "dataframe", "records"
 
         """
+    if output not in ("json", "dataframe", "records"):
+        raise ValueError('Invalid value for "output". Must be one of ["json", "dataframe", "records"]')
     data_file = Path(__file__).parent.joinpath("paralympics.xlsx")
     try:
         if not data_file.exists():
             raise FileNotFoundError(f"Data file not found: {data_file}")
-        df = pd.read_excel(data_file)
+        df = _read_event_frame(data_file)
+        if output == "dataframe":
+            return df
+        if output == "records":
+            return _iter_records(df)
         if df.empty:
             return []
         json_data = df.to_json(orient='records')
@@ -233,13 +779,231 @@ def get_event_data():
         raise RuntimeError(f"Unexpected error loading event data: {e}") from e
 
 
-def add_quiz_data():
-    """ Method to add question data to the paralympics database."""
-    database_file = Path(__file__).parent.joinpath("paralympics.db")
+def import_event_data(database_file: Optional[Path] = None) -> Dict[str, int]:
+    """ Method to add games and hosts from the paralympics .xlsx file to the database.
+
+    The import is incremental: only games (by event type and year), hosts (by place name) and
+    games/host links that are not already in the database are added, so it can be run again
+    whenever the .xlsx changes. A country is added if a new host's country is not found by name.
+
+    Args:
+        database_file: path to the database file, defaults to paralympics.db
+
+    Returns:
+        added: number of rows added to each table
+    """
+    database_file = database_file or Path(__file__).parent.joinpath("paralympics.db")
+    df = get_event_data(output="dataframe")
+    added = {"country": 0, "host": 0, "games": 0, "games_host": 0}
     with sqlite3.connect(database_file) as conn:
         cur = conn.cursor()
-        for sql_file in ("question.sql", "response.sql"):
-            sql_path = Path(__file__).parent.joinpath(sql_file)
-            cur.executescript(sql_path.read_text())
+        countries = {name: cid for cid, name in cur.execute("SELECT id, country_name FROM country")}
+        hosts = {name: hid for hid, name in cur.execute("SELECT id, place_name FROM host")}
+        games = {(event_type, year): gid
+                 for gid, event_type, year in cur.execute("SELECT id, event_type, year FROM games")}
+        links = set(cur.execute("SELECT games_id, host_id FROM games_host"))
+
+        for row in _iter_records(df):
+            place_name = row["host"]
+            if place_name not in hosts:
+                country_name = row["country_name"]
+                if country_name not in countries:
+                    cur.execute("INSERT INTO country (country_name) VALUES (?)", (country_name,))
+                    countries[country_name] = cur.lastrowid
+                    added["country"] += 1
+                cur.execute(
+                    "INSERT INTO host (place_name, country_id, latitude, longitude) "
+                    "VALUES (?, ?, ?, ?)",
+                    (place_name, countries[country_name], row["latitude"], row["longitude"]),
+                )
+                hosts[place_name] = cur.lastrowid
+                added["host"] += 1
+
+            key = (row["type"].strip().lower(), int(row["year"]))
+            if key not in games:
+                cur.execute(
+                    "INSERT INTO games (event_type, year, start_date, end_date, countries, events, "
+                    "sports, participants_m, participants_f, participants, highlights, url) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (*key, _format_date(row["start"]), _format_date(row["end"]),
+                     *(_int_or_none(row[c]) for c in ("countries", "events", "sports",
+                                                       "participants_m", "participants_f",
+                                                       "participants")),
+                     row["highlights"], row["URL"]),
+                )
+                games[key] = cur.lastrowid
+                added["games"] += 1
+
+            link = (games[key], hosts[place_name])
+            if link not in links:
+                cur.execute("INSERT INTO games_host (games_id, host_id) VALUES (?, ?)", link)
+                links.add(link)
+                added["games_host"] += 1
         conn.commit()
+    return added
+
+
+def _format_date(value) -> Optional[str]:
+    """ Formats a date from the .xlsx in the same format as the database, e.g. 18-09-1960 """
+    return value.strftime("%d-%m-%Y") if value is not None else None
+
+
+def _int_or_none(value) -> Optional[int]:
+    return int(value) if value is not None else None
+
 
+def _read_seed_file(seed_file: Path, conn: sqlite3.Connection) -> Iterator[tuple]:
+    """ Parses a seed file and yields (table_name, columns, rows) for each table in it.
+
+    - .sql: INSERT statements, run against an empty in-memory copy of the database schema so
+      that SQLite does the parsing
+    - .csv: rows for the table with the same name as the file, the first line has the column names.
+      An empty file is skipped
+    - .json: a list of objects for the table with the same name as the file, or an object that
+      maps table names to lists of objects
+
+    Args:
+        seed_file: path to the seed file
+        conn: connection to the database being loaded, used to copy the schema for .sql files
+    """
+    suffix = seed_file.suffix.lower()
+    if suffix == ".sql":
+        memory = sqlite3.connect(":memory:")
+        try:
+            # SQLite's own tables, e.g. sqlite_sequence for AUTOINCREMENT, can't be created and are
+            # created again by SQLite when needed
+            for (sql,) in conn.execute(
+                    "SELECT sql FROM sqlite_master WHERE type='table' AND sql IS NOT NULL "
+                    "AND name NOT LIKE 'sqlite_%'"):
+                memory.execute(sql)
+            memory.executescript(seed_file.read_text())
+            tables = [row[0] for row in memory.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+            for table_name in tables:
+                cur = memory.execute(f"SELECT * FROM '{table_name}'")
+                columns = [d[0] for d in cur.description]
+                rows = cur.fetchall()
+                if rows:
+                    yield table_name, columns, rows
+        finally:
+            memory.close()
+    elif suffix == ".csv":
+        with seed_file.open(newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            columns = next(reader, None)
+            if columns is None:
+                return  # empty file, nothing to load
+            # CSV has no NULL, treat empty values as NULL
+            yield seed_file.stem, columns, ([v if v != "" else None for v in r] for r in reader)
+    elif suffix == ".json":
+        content = json.loads(seed_file.read_text())
+        if isinstance(content, list):
+            content = {seed_file.stem: content}
+        for table_name, records in content.items():
+            columns = list(dict.fromkeys(k for record in records for k in record))
+            yield table_name, columns, [tuple(r.get(c) for c in columns) for r in records]
+    else:
+        raise ValueError(f"Unsupported seed file type: {seed_file}")
+
+
+def load_seed_files(seed_files: List[Path], database_file: Optional[Path] = None,
+                    on_conflict: str = "ignore", batch_size: int = 10000) -> Dict[str, Dict[str, int]]:
+    """ Method to bulk load seed data (.sql, .csv or .json files) into the database.
+
+    All files are loaded in a single transaction, so either all rows are loaded or, if there is
+    an error, none are. Rows are inserted in batches with executemany. Rows that have the same
+    primary key (or other unique value) as an existing row are skipped, or updated if
+    on_conflict is "update", so the same files can be loaded more than once.
+
+    Args:
+        seed_files: paths to the seed files, see _read_seed_file for the formats
+        database_file: path to the database file, defaults to paralympics.db
+        on_conflict: "ignore" to skip rows that already exist, "update" to overwrite them
+        batch_size: number of rows per executemany call
+
+    Returns:
+        results: for each table the number of rows read and the number inserted and skipped
+            (or updated), e.g. {"question": {"rows": 4, "inserted": 0, "skipped": 4}}
+
+    Raises:
+        ValueError: if on_conflict is invalid, or a seed file or table is not supported
+        RuntimeError: if the data could not be loaded, in which case nothing is loaded
+    """
+    if on_conflict not in ("ignore", "update"):
+        raise ValueError('Invalid value for "on_conflict". Must be one of ["ignore", "update"]')
+    database_file = database_file or Path(__file__).parent.joinpath("paralympics.db")
+    existing_key = "skipped" if on_conflict == "ignore" else "updated"
+    results: Dict[str, Dict[str, int]] = {}
+    # isolation_level=None so the transaction is controlled by the BEGIN/COMMIT below
+    conn = sqlite3.connect(database_file, isolation_level=None)
+    try:
+        # Bulk load settings, these only last for this connection. The journal is kept so the
+        # load can be rolled back.
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -64000")  # 64MB
+        conn.execute("BEGIN IMMEDIATE")
+        for seed_file in seed_files:
+            for table_name, columns, rows in _read_seed_file(Path(seed_file), conn):
+                table_info = conn.execute(f"PRAGMA table_info('{table_name}')").fetchall()
+                if not table_info:
+                    raise ValueError(f"Table {table_name} does not exist")
+                table_cols = {row[1] for row in table_info}
+                pk_cols = [row[1] for row in sorted(table_info, key=lambda r: r[5]) if row[5]]
+                # Keep only known columns
+                keep = [i for i, c in enumerate(columns) if c in table_cols]
+                cols = [columns[i] for i in keep]
+                if not cols:
+                    raise ValueError(f"No valid columns for table {table_name} in {seed_file}")
+
+                columns_sql = ", ".join(f'"{c}"' for c in cols)
+                placeholders = ", ".join("?" for _ in cols)
+                sql = f"INSERT INTO '{table_name}' ({columns_sql}) VALUES ({placeholders}) "
+                updates = [c for c in cols if c not in pk_cols]
+                if on_conflict == "update" and pk_cols and set(pk_cols) <= set(cols) and updates:
+                    pk_sql = ", ".join(f'"{c}"' for c in pk_cols)
+                    set_sql = ", ".join(f'"{c}" = excluded."{c}"' for c in updates)
+                    sql += f"ON CONFLICT ({pk_sql}) DO UPDATE SET {set_sql}"
+                else:
+                    sql += "ON CONFLICT DO NOTHING"
+
+                before = conn.execute(f"SELECT count(*) FROM '{table_name}'").fetchone()[0]
+                total = 0
+                batch = []
+                for row in rows:
+                    batch.append(tuple(row[i] for i in keep))
+                    if len(batch) >= batch_size:
+                        conn.executemany(sql, batch)
+                        total += len(batch)
+                        batch = []
+                if batch:
+                    conn.executemany(sql, batch)
+                    total += len(batch)
+                inserted = conn.execute(f"SELECT count(*) FROM '{table_name}'").fetchone()[0] - before
+
+                result = results.setdefault(table_name, {"rows": 0, "inserted": 0, existing_key: 0})
+                result["rows"] += total
+                result["inserted"] += inserted
+                result[existing_key] += total - inserted
+        conn.execute("COMMIT")
+        return results
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if isinstance(e, ValueError):
+            raise
+        raise RuntimeError(f"Error loading seed data: {e}") from e
+    finally:
+        conn.close()
+
+
+def add_quiz_data():
+    """ Method to add question data to the paralympics database.
+
+    Can be run more than once, questions and responses that are already in the database are skipped.
+
+    Returns:
+        results: the number of rows inserted and skipped for each table, see load_seed_files
+    """
+    data_dir = Path(__file__).parent
+    return load_seed_files([data_dir.joinpath("question.sql"), data_dir.joinpath("response.sql")])
@@ -5,21 +5,54 @@
  do not use this as an example for coursework 2!
 
  """
-from typing import Callable
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Set, Tuple
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, StreamingResponse
 
+from src.data.compression import CompressionMiddleware
 from src.data.data import ParalympicsData
 
-app = FastAPI(title="Mock Paralympics API")
+# Seconds between checks for rows added by other processes, e.g. other workers, see _watch_for_changes
+POLL_INTERVAL = float(os.environ.get("PARALYMPICS_POLL_INTERVAL", "0.5"))
+
+
+async def _watch_for_changes():
+    """ Regularly checks the database for rows added by other processes
+
+    When the API runs with several workers each worker has its own ParalympicsData, so a row added
+    through one worker is found here by the others. They then update their versions and snapshot,
+    and send the table-change event to their /events clients.
+    """
+    while True:
+        await asyncio.sleep(POLL_INTERVAL)
+        try:
+            await asyncio.to_thread(data.check_for_changes)
+        except RuntimeError:
+            pass  # e.g. the database was busy, try again next time
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    watcher = asyncio.create_task(_watch_for_changes())
+    yield
+    watcher.cancel()
+
+
+app = FastAPI(title="Mock Paralympics API", lifespan=lifespan)
 
 origins = [
     "http://localhost",
     "http://127.0.0.1",
     "http://localhost:8050",  # dash default
+    "http://127.0.0.1:8050",  # dash default, needed for the /events stream
     "http://localhost:5000",  # flask default
     "http://localhost:8501",  # streamlit default
 ]
@@ -32,8 +65,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-data = ParalympicsData()
-_tables = data.tables
+# Compress responses of 500 bytes or more with brotli or gzip, whichever the client accepts
+app.add_middleware(CompressionMiddleware, minimum_size=500)
+
+# Set PARALYMPICS_SNAPSHOT=1 to serve reads from an in-memory copy of the database
+# Set PARALYMPICS_WAL=1 to use WAL journal mode, needed if more than one process writes to it
+# Set PARALYMPICS_DATABASE to the path of a database file to use instead of paralympics.db
+data = ParalympicsData(snapshot=bool(os.environ.get("PARALYMPICS_SNAPSHOT")),
+                       wal=bool(os.environ.get("PARALYMPICS_WAL")),
+                       database_file=os.environ.get("PARALYMPICS_DATABASE"))
+
+# Queues of the clients connected to /events, with the event loop each queue belongs to
+_subscribers: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = set()
+
+
+def _publish_change(table_name: str, row: Dict):
+    """ Sends a table-change event to every client connected to /events """
+    event = {"table": table_name, "version": data.versions[table_name], "row": row}
+    for loop, queue in list(_subscribers):
+        loop.call_soon_threadsafe(_put_event, queue, event)
+
+
+def _put_event(queue: asyncio.Queue, event: Dict):
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        # The client is not reading its events fast enough. Dropping events would leave its cached
+        # data for those tables stale, so instead its stream is closed (None), the client then
+        # reconnects and, as it may have missed changes, clears all its cached data.
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+
+data.add_listener(_publish_change)
+
+# Tables joined by data.get_all_data() for the /all route
+_ALL_DATA_TABLES = ("games", "games_host", "host", "country")
+
+
+def _etag(*table_names: str) -> str:
+    """ Returns a weak ETag for data read from the tables, it changes whenever a row is added """
+    return 'W/"' + "-".join(f"{t}.{data.versions.get(t, 0)}" for t in table_names) + '"'
 
 
 @app.get("/", summary="API documentation")
@@ -49,40 +122,130 @@ async def root(request: Request):
     raise HTTPException(status_code=404, detail="No API docs configured")
 
 
-def _make_get_all_route(table_name: str) -> Callable:
-    """ Create a GET /<table> route to get all data from a table """
+# Create a route to get data for the charts
+@app.get("/all")
+def get_all(response: Response):
+    try:
+        response.headers["ETag"] = _etag(*_ALL_DATA_TABLES)
+        return data.get_all_data()
+    except AttributeError:
+        raise HTTPException(status_code=500, detail="ParalympicsData.get_json not implemented")
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+
+@app.get("/events", summary="Stream of table changes (Server-Sent Events)")
+async def events(request: Request):
+    """
+    Server-Sent Events stream with an event each time a row is added to a table.
 
-    async def _route():
-        try:
-            return data.get_table_as_json(table_name)
-        except AttributeError:
-            raise HTTPException(status_code=500, detail="ParalympicsData.get_json not implemented")
-        except Exception as exc:
-            raise HTTPException(status_code=500, detail=str(exc))
+    Each event is named 'table-change' and the data is JSON with the table name, the table's new
+    version number and the new row, e.g.
+    {"table": "question", "version": 1, "row": {"id": 5, "question_text": "..."}}
 
-    return _route
+    Clients can use this to refresh only the data that has changed instead of polling.
 
+    If a client falls more than 100 events behind its stream is closed. Changes may then have been
+    missed, so a client should refresh all of its data when it reconnects.
 
-def _make_get_by_id_route(table_name: str) -> Callable:
-    """ Create a GET /<table>/{item_id} route to get a row by its primary key """
+    Example (JavaScript):
+    const source = new EventSource("http://127.0.0.1:8000/events");
+    source.addEventListener("table-change", (e) => console.log(JSON.parse(e.data)));
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=100)
+    subscriber = (asyncio.get_running_loop(), queue)
+    _subscribers.add(subscriber)
 
-    async def _route(item_id: int):
+    async def _stream():
         try:
-            row = data.get_row_by_id(table_name, item_id)
-            if row is None:
-                raise HTTPException(status_code=404, detail="Item not found")
-            return row
-        except HTTPException:
-            raise
-        except Exception as exc:
-            raise HTTPException(status_code=500, detail=str(exc))
+            yield "retry: 3000\n\n"  # ask the browser to reconnect after 3s if disconnected
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"  # a comment line, stops proxies closing the connection
+                    continue
+                if event is None:
+                    break  # too many events were waiting, see _put_event
+                yield f"event: table-change\ndata: {json.dumps(event)}\n\n"
+        finally:
+            _subscribers.discard(subscriber)
+
+    return StreamingResponse(_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+# --- TABLE ROUTES ---
+# One set of routes for every table, with the table name as a path parameter. These are added last
+# so the fixed routes above (/all, /events) are matched first.
+# The routes that use the database are plain functions (def, not async def), or run the database
+# calls with run_in_threadpool. FastAPI then runs them in a thread, so a read or a write waiting for
+# the database doesn't stop the event loop handling other requests and the /events streams.
+
+# Seconds between reads of the list of tables caused by requests for tables that don't exist
+TABLE_REFRESH_INTERVAL = 1.0
+
+
+def _check_table(table_name: str):
+    """ Raises a 404 error if there is no table with that name in the database
+
+    The table names are cached by ParalympicsData. They are only read from the database again when
+    a name is not found, so tables added to the database while the API is running can be used. To
+    stop requests for names that aren't tables (e.g. /favicon.ico or typos) querying the database
+    every time, the names are read at most once every TABLE_REFRESH_INTERVAL seconds.
+    """
+    if table_name not in data.tables and table_name not in data.refresh_tables(TABLE_REFRESH_INTERVAL):
+        raise HTTPException(status_code=404, detail=f"Table {table_name} not found")
 
-    return _route
+
+def _expand_etag(table_name: str, expand: Optional[str]) -> str:
+    """ Returns the ETag for rows of a table with the related tables in expand, or a 400 error if
+    expand is not valid for the table """
+    try:
+        return _etag(*data.expand_tables(table_name, expand))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
 
 
-def _make_search_route(table_name: str) -> Callable:
+@app.get("/{table_name}", summary="Get all rows from a table, or the rows with the given ids")
+def get_table(table_name: str, response: Response, ids: Optional[str] = None,
+              expand: Optional[str] = None):
     """
-    Create a GET '/<table>/search' route that accepts query parameters to filter rows.
+    Returns all rows from a table, e.g. /games
+
+    With ids, a comma separated list of primary keys, only those rows are returned, fetched with a
+    single query rather than a request to /{table_name}/{item_id} for each. The response is then
+    a JSON object with the rows in the order of the ids, and the ids that were not found, e.g.
+
+    /games?ids=1,2,999 -> {"rows": [{"id": 1, ...}, {"id": 2, ...}], "missing": [999]}
+
+    With expand, each row includes its related rows from other tables, found from the foreign
+    keys, so they don't need to be requested separately. Separate relations with commas and use
+    dots for the relations of a related table, up to 3 levels, e.g.
+
+    /games?expand=games_host.host.country,games_disability.disability
+
+    A foreign key in the table gives the related row (e.g. host -> country), a foreign key in
+    another table that refers to this one gives a list of rows (e.g. games -> games_host).
+    """
+    _check_table(table_name)
+    try:
+        item_ids = [int(i) for i in ids.split(",") if i.strip()] if ids is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma separated list of integers")
+    response.headers["ETag"] = _expand_etag(table_name, expand)
+    try:
+        if item_ids is not None:
+            return data.get_rows_by_ids(table_name, item_ids, expand=expand)
+        return data.get_table_as_json(table_name, expand=expand)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+
+@app.get("/{table_name}/search", summary="Search a table")
+def search_table(table_name: str, request: Request):
+    """
+    Returns the rows from a table that match the query parameters.
 
     Usage:
     - Provide one or more query parameters where each key is a column name and the
@@ -98,23 +261,44 @@ def _make_search_route(table_name: str) -> Callable:
     - Matching is exact equality (\"column\" = ?). Wildcards/partial matches are not supported.
     - If no valid query parameters are supplied, the endpoint returns all rows for the table.
     """
+    _check_table(table_name)
+    try:
+        params = dict(request.query_params)
+        return data.search_table(table_name, params)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
 
-    async def _route(request: Request):
-        try:
-            params = dict(request.query_params)
-            return data.search_table(table_name, params)
-        except Exception as exc:
-            raise HTTPException(status_code=500, detail=str(exc))
 
-    return _route
+@app.get("/{table_name}/{item_id}", summary="Get a row from a table by its id")
+def get_row(table_name: str, item_id: int, response: Response, expand: Optional[str] = None):
+    """
+    Returns the row from a table with the primary key item_id, e.g. /games/1
+
+    With expand, the row includes its related rows from other tables, see GET /{table_name}, e.g.
 
+    /games/1?expand=games_host.host.country,games_disability.disability
+    """
+    _check_table(table_name)
+    if expand:
+        response.headers["ETag"] = _expand_etag(table_name, expand)
+    try:
+        row = data.get_row_by_id(table_name, item_id, expand=expand)
+        if row is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        return row
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
 
-def _make_post_route(table_name: str) -> Callable:
+
+@app.post("/{table_name}", summary="Add a row to a table")
+async def add_row(table_name: str, request: Request):
     """
-    Create a POST '/<table>' route to insert a new row.
+    Inserts a new row into a table.
 
     Usage:
-    - Send HTTP POST to /{table} with a JSON object body (Content-Type: application/json).
+    - Send HTTP POST to /{table_name} with a JSON object body (Content-Type: application/json).
     - Only keys that match existing column names are used; unknown keys are ignored.
     - On success the endpoint returns the inserted row as JSON. If the table has a primary key
       the returned row is fetched by that key; otherwise the row is returned using SQLite's rowid.
@@ -122,47 +306,34 @@ def _make_post_route(table_name: str) -> Callable:
     Responses:
     - 200: inserted row as JSON.
     - 400: request body is not a JSON object.
+    - 404: the table does not exist.
     - 500: database or server errors (for example, no valid columns provided for insert).
 
     Example:
-    curl -X POST 'http://localhost:8000/{table}' \\
+    curl -X POST 'http://localhost:8000/{table_name}' \\
          -H 'Content-Type: application/json' \\
          -d '{"column1":"value1","column2":123}'
     """
-
-    async def _route(request: Request):
-        try:
-            payload = await request.json()
-            if not isinstance(payload, dict):
-                raise HTTPException(status_code=400, detail="Request body must be a JSON object")
-            new_row = data.add_row(table_name, payload)
-            return new_row
-        except HTTPException:
-            raise
-        except Exception as exc:
-            raise HTTPException(status_code=500, detail=str(exc))
-
-    return _route
-
-
-# create the routes for each table
-for _t in _tables:
-    app.get(f"/{_t}", name=f"{_t}_all")(_make_get_all_route(_t))
-    app.get(f"/{_t}/search", name=f"{_t}_search")(_make_search_route(_t))
-    app.get(f"/{_t}/{{item_id}}", name=f"{_t}_get")(_make_get_by_id_route(_t))
-    app.post(f"/{_t}", name=f"{_t}_post")(_make_post_route(_t))
-
-
-# Create a route to get data for the charts
-@app.get("/all")
-async def get_all():
+    await run_in_threadpool(_check_table, table_name)
     try:
-        return data.get_all_data()
-    except AttributeError:
-        raise HTTPException(status_code=500, detail="ParalympicsData.get_json not implemented")
+        payload = await request.json()
+        if not isinstance(payload, dict):
+            raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+        new_row = await run_in_threadpool(data.add_row, table_name, payload)
+        return new_row
+    except HTTPException:
+        raise
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
 
 if __name__ == "__main__":
-    uvicorn.run("src.data.mock_api:app", host="127.0.0.1", port=8000, reload=True)
+    # Set PARALYMPICS_WORKERS to run that many worker processes, e.g.
+    #   PARALYMPICS_WORKERS=4 python -m src.data.mock_api
+    # Each worker has its own data, snapshot and caches. They share only the database file.
+    workers = int(os.environ.get("PARALYMPICS_WORKERS", "1"))
+    if workers > 1:
+        os.environ["PARALYMPICS_WAL"] = "1"  # inherited by the workers
+        uvicorn.run("src.data.mock_api:app", host="127.0.0.1", port=8000, workers=workers)
+    else:
+        uvicorn.run("src.data.mock_api:app", host="127.0.0.1", port=8000, reload=True)
@@ -0,0 +1,353 @@
+""" Load test that simulates a classroom of students using the dashboard at the same time.
+
+Each simulated student opens the dashboard, explores the three charts and then works through the
+quiz, in the same order of requests that the browser would send. Optional simulated teachers
+create new questions using the Teacher admin form, and optional API clients call the mock_api
+routes directly.
+
+The test needs httpx, install it with:
+
+    pip install -e .[loadtest]
+
+Usage (run from the project root):
+
+    python -m src.loadtest.classroom --students 30 --start-servers
+
+Use --start-servers to start the mock_api and the Dash app locally for the test, otherwise both
+must already be running at --api-url and --dash-url. Run with --help to see all the options.
+
+NB: each teacher adds a question and four responses to paralympics.db, so only use --teachers with
+a copy of the database you don't mind changing.
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+PROJECT_ROOT = Path(__file__).parents[2]
+LINE_FEATURES = ["sports", "events", "countries", "participants"]
+BAR_SELECTIONS = [["winter"], ["winter", "summer"], ["summer"]]
+
+
+class Stats:
+    """ Collects the latency of each request, grouped by the name of the step in the flow.
+
+    Methods:
+        add(self, name, seconds, ok): Records a request
+        report(self, elapsed): Returns the results as printable text
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def add(self, name: str, seconds: float, ok: bool = True):
+        """ Records the latency of a request, and whether it failed """
+        self.latencies[name].append(seconds)
+        if not ok:
+            self.errors[name] += 1
+
+    def report(self, elapsed: float) -> str:
+        """ Returns a table of p50/p95/p99 latency (ms) and throughput for each step and in total
+
+        Args:
+            elapsed (float): duration of the test in seconds
+        """
+        lines = [f"{'step':<28}{'requests':>9}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'req/s':>9}"]
+        rows = sorted(self.latencies.items())
+        rows.append(("TOTAL", [s for values in self.latencies.values() for s in values]))
+        for name, values in rows:
+            errors = sum(self.errors.values()) if name == "TOTAL" else self.errors[name]
+            p50, p95, p99 = (percentile(values, p) * 1000 for p in (50, 95, 99))
+            lines.append(f"{name:<28}{len(values):>9}{errors:>8}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}"
+                         f"{len(values) / elapsed:>9.1f}")
+        return "\n".join(lines)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """ Returns the nearest-rank percentile of the values, or 0 if there are none """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class DashClient:
+    """ Sends callback requests to the Dash `_dash-update-component` endpoint like the browser does.
+
+    The callback outputs are looked up from `_dash-dependencies`, so the requests still match the app
+    if the callbacks in app.py change.
+
+    Methods:
+        load(self): Loads the page, layout and callback dependencies
+        trigger(self, name, input_id, value, prop, state): Fires the callback for an input
+    """
+
+    def __init__(self, client: httpx.AsyncClient, stats: Stats, dependencies: List[Dict]):
+        self.client = client
+        self.stats = stats
+        self.dependencies = dependencies
+
+    async def load(self):
+        """ Requests what the browser requests when the dashboard is opened """
+        await timed(self.stats, "page", self.client.get("/"))
+        await timed(self.stats, "layout", self.client.get("/_dash-layout"))
+        await timed(self.stats, "dependencies", self.client.get("/_dash-dependencies"))
+
+    async def trigger(self, name: str, input_id: str, value, prop: str = "value",
+                      state: Optional[Dict[str, object]] = None) -> Optional[Dict]:
+        """ Fires the callback that has input_id.prop as an Input
+
+        Args:
+            name (str): name of the step used in the results
+            input_id (str): id of the component that changed
+            value: the new value of the property
+            prop (str): the property that changed
+            state (dict): values for the callback State, keyed by "id.property"
+
+        Returns:
+            response (dict): the callback response, or None if the update was prevented or failed
+        """
+        state = state or {}
+        dependency = next(d for d in self.dependencies
+                          if any(i["id"] == input_id and i["property"] == prop for i in d["inputs"]))
+        payload = {
+            "output": dependency["output"],
+            "outputs": callback_outputs(dependency["output"]),
+            "inputs": [{"id": input_id, "property": prop, "value": value}],
+            "changedPropIds": [f"{input_id}.{prop}"],
+            "state": [{**s, "value": state.get(f"{s['id']}.{s['property']}")}
+                      for s in dependency["state"]],
+        }
+        response = await timed(self.stats, name,
+                               self.client.post("/_dash-update-component", json=payload),
+                               ok_status=(200, 204))
+        if response is None or response.status_code == 204:
+            return None
+        return response.json()
+
+
+def callback_outputs(output: str):
+    """ Converts a callback output string from _dash-dependencies to the request 'outputs' value
+
+    e.g. '..q_index.data...result.children..' or 'chart-display.children@<hash>'
+    """
+    multi = output.startswith("..")
+    parts = output[2:-2].split("...") if multi else [output]
+    outputs = []
+    for part in parts:
+        component_id, prop = part.rsplit(".", 1)
+        outputs.append({"id": component_id, "property": prop.split("@")[0]})
+    return outputs if multi else outputs[0]
+
+
+async def timed(stats: Stats, name: str, request, ok_status=(200,)) -> Optional[httpx.Response]:
+    """ Awaits the request and records its latency, returns None if it failed """
+    start = time.perf_counter()
+    try:
+        response = await request
+    except httpx.HTTPError:
+        stats.add(name, time.perf_counter() - start, ok=False)
+        return None
+    ok = response.status_code in ok_status
+    stats.add(name, time.perf_counter() - start, ok=ok)
+    return response if ok else None
+
+
+async def think(think_time: float):
+    """ Pauses like a user reading the page, for up to think_time seconds """
+    if think_time:
+        await asyncio.sleep(random.uniform(think_time / 2, think_time))
+
+
+async def student(dash: DashClient, api: httpx.AsyncClient, think_time: float):
+    """ Explores each chart, then answers the quiz questions, sometimes getting one wrong first """
+    await dash.load()
+
+    await think(think_time)
+    await dash.trigger("select line chart", "select-chart", "line")
+    # The charts are updated in place, so keep the stores the browser would send back as State
+    line_state = None
+    for feature in random.sample(LINE_FEATURES, 2):
+        await think(think_time)
+        result = await dash.trigger("line chart feature", "line-select", feature,
+                                    state={"line-chart-state.data": line_state})
+        if result:
+            line_state = result["response"]["line-chart-state"]["data"]
+
+    await think(think_time)
+    await dash.trigger("select bar chart", "select-chart", "bar")
+    built = []
+    for selection in BAR_SELECTIONS:
+        await think(think_time)
+        result = await dash.trigger("bar chart checklist", "checklist-barchart", selection,
+                                    state={"barchart-built.data": built})
+        if result:
+            built = result["response"]["barchart-built"]["data"]
+
+    await think(think_time)
+    await dash.trigger("select map", "select-chart", "map")
+
+    # The student 'knows' the answers by asking the API, so they can get to the end of the quiz
+    questions = await timed(dash.stats, "api: questions", api.get("/question"))
+    if questions is None:
+        return
+    index = 1
+    while index <= len(questions.json()):
+        responses = await timed(dash.stats, "api: responses",
+                                api.get("/response/search", params={"question_id": index}))
+        if responses is None:
+            return
+        options = responses.json()
+        answers = [r["id"] for r in options if r["is_correct"]]
+        if random.random() < 0.3:
+            answers.insert(0, random.choice([r["id"] for r in options if not r["is_correct"]]))
+        for clicks, answer in enumerate(answers, start=1):
+            await think(think_time)
+            result = await dash.trigger("submit answer", "submit-btn", clicks, prop="n_clicks",
+                                        state={"q_index.data": index, "question-radio.value": answer})
+            if result is None:
+                return
+            new_index = result["response"]["q_index"]["data"]
+            if new_index != index:
+                index = new_index
+                await dash.trigger("render question", "q_index", index, prop="data")
+                break
+        else:
+            return  # answered the last question
+
+
+async def teacher(dash: DashClient, think_time: float):
+    """ Opens the dashboard and adds a new question using the Teacher admin form """
+    await dash.load()
+    await think(think_time)
+    correct = random.randrange(4)
+    state = {"question_text.value": "Load test question?"}
+    for i in range(4):
+        state[f"response_text_{i}.value"] = f"Response {i}"
+        state[f"is-correct_{i}.value"] = i == correct
+    await dash.trigger("create question", "new-question-submit-button", 1, prop="n_clicks",
+                       state=state)
+
+
+async def api_client(stats: Stats, api: httpx.AsyncClient, think_time: float):
+    """ Calls the mock_api routes directly, as another app using the API would """
+    await timed(stats, "api: all", api.get("/all"))
+    for table in ("games", "host", "country"):
+        await think(think_time)
+        await timed(stats, f"api: {table}", api.get(f"/{table}"))
+    await think(think_time)
+    await timed(stats, "api: games by id", api.get(f"/games/{random.randint(1, 30)}"))
+    await timed(stats, "api: games search", api.get("/games/search", params={"event_type": "winter"}))
+
+
+async def run(args) -> Stats:
+    """ Starts the simulated users, spread evenly over the ramp up time, and waits for them all """
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.students + args.teachers + args.api_clients + 10)
+    async with httpx.AsyncClient(base_url=args.dash_url, timeout=args.timeout, limits=limits) as dash_http, \
+            httpx.AsyncClient(base_url=args.api_url, timeout=args.timeout, limits=limits) as api_http:
+        dependencies = (await dash_http.get("/_dash-dependencies")).raise_for_status().json()
+        dash = DashClient(dash_http, stats, dependencies)
+        users = ([student(dash, api_http, args.think) for _ in range(args.students)]
+                 + [teacher(dash, args.think) for _ in range(args.teachers)]
+                 + [api_client(stats, api_http, args.think) for _ in range(args.api_clients)])
+        random.shuffle(users)
+
+        async def _start(delay, user):
+            await asyncio.sleep(delay)
+            await user
+
+        step = args.ramp / len(users) if users else 0
+        await asyncio.gather(*(_start(i * step, u) for i, u in enumerate(users)))
+    return stats
+
+
+def start_servers(api_url: str, dash_url: str, api_workers: int = 1) -> List[subprocess.Popen]:
+    """ Starts the mock_api and the Dash app (without debug mode) and waits until both respond
+
+    With more than one API worker the database is used in WAL mode, see ParalympicsData.
+    """
+    api_port = httpx.URL(api_url).port or 8000
+    dash_port = httpx.URL(dash_url).port or 8050
+    api_env = dict(os.environ, PARALYMPICS_WAL="1") if api_workers > 1 else None
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.data.mock_api:app", "--port", str(api_port),
+         "--log-level", "warning", "--workers", str(api_workers),
+         # don't wait for /events streams to close when stopping
+         "--timeout-graceful-shutdown", "2"],
+        cwd=PROJECT_ROOT,
+        env=api_env,
+    )
+    _wait_for(api_url)
+    dash = subprocess.Popen(
+        [sys.executable, "-c",
+         "import logging; logging.getLogger('werkzeug').setLevel(logging.WARNING); "
+         f"from paralympics.app import app; app.run(port={dash_port}, debug=False)"],
+        cwd=PROJECT_ROOT,
+    )
+    _wait_for(dash_url)
+    return [api, dash]
+
+
+def stop_servers(servers: List[subprocess.Popen]):
+    """ Stops the servers started by start_servers, the Dash app first as it is a client of the API """
+    for server in reversed(servers):
+        server.terminate()
+        server.wait()
+
+
+def _wait_for(url: str, seconds: float = 30):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start: {url}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--students", type=int, default=30, help="number of simulated students")
+    parser.add_argument("--teachers", type=int, default=0,
+                        help="number of simulated teachers, each adds a question to the database")
+    parser.add_argument("--api-clients", type=int, default=0,
+                        help="number of clients calling the mock_api routes directly")
+    parser.add_argument("--ramp", type=float, default=5,
+                        help="seconds over which the users start (0 = all at once)")
+    parser.add_argument("--think", type=float, default=1,
+                        help="maximum pause in seconds between a user's actions")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout in seconds")
+    parser.add_argument("--api-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--dash-url", default="http://127.0.0.1:8050")
+    parser.add_argument("--start-servers", action="store_true",
+                        help="start the mock_api and Dash app locally for the test")
+    parser.add_argument("--api-workers", type=int, default=1,
+                        help="number of mock_api worker processes when using --start-servers")
+    args = parser.parse_args()
+
+    servers = start_servers(args.api_url, args.dash_url, args.api_workers) if args.start_servers else []
+    try:
+        start = time.perf_counter()
+        stats = asyncio.run(run(args))
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_servers(servers)
+    print(f"{args.students} students, {args.teachers} teachers, {args.api_clients} API clients, "
+          f"{elapsed:.1f}s\n")
+    print(stats.report(elapsed))
+
+
+if __name__ == "__main__":
+    main()
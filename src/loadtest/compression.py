@@ -0,0 +1,116 @@
+""" Benchmark of response compression for the mock_api and Dash app routes.
+
+For each route the response is requested without compression, with gzip and with brotli, and the
+bytes sent over the network and the mean response time are reported. The CPU time to compress
+the response body (measured locally with the same settings as the servers) is also shown.
+
+The benchmark needs httpx, install it with:
+
+    pip install -e .[loadtest]
+
+Usage (run from the project root):
+
+    python -m src.loadtest.compression --start-servers
+"""
+import argparse
+import gzip
+import time
+from typing import Dict, List, Optional, Tuple
+
+import brotli
+import httpx
+
+from src.loadtest.classroom import callback_outputs, start_servers, stop_servers
+
+API_ROUTES = ["/all", "/games", "/country", "/team", "/question", "/games/1", "/openapi.json"]
+# Dash callbacks to benchmark: (name, input id, input property, value)
+DASH_CALLBACKS = [
+    ("callback: line chart", "line-select", "value", "participants"),
+    ("callback: bar chart", "checklist-barchart", "value", ["winter", "summer"]),
+    ("callback: map", "select-chart", "value", "map"),
+]
+ENCODINGS = ["identity", "gzip", "br"]
+
+
+def measure(client: httpx.Client, method: str, url: str, encoding: str, repeat: int,
+            json: Optional[Dict] = None) -> Tuple[int, float, bytes]:
+    """ Returns the bytes on the wire, the mean time in ms and the decoded body of a request """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.request(method, url, json=json, headers={"Accept-Encoding": encoding})
+        times.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return response.num_bytes_downloaded, sum(times) / len(times) * 1000, response.content
+
+
+def compress_cpu_ms(body: bytes, repeat: int = 20) -> Tuple[float, float]:
+    """ Returns the CPU time in ms to gzip (level 6) and brotli (quality 4) compress the body """
+    results = []
+    for compress in (lambda b: gzip.compress(b, compresslevel=6), lambda b: brotli.compress(b, quality=4)):
+        start = time.process_time()
+        for _ in range(repeat):
+            compress(body)
+        results.append((time.process_time() - start) / repeat * 1000)
+    return results[0], results[1]
+
+
+def benchmark(api_url: str, dash_url: str, repeat: int) -> List[Tuple]:
+    """ Returns a row of results for each route """
+    rows = []
+    with httpx.Client(base_url=api_url, timeout=30) as api, \
+            httpx.Client(base_url=dash_url, timeout=30) as dash:
+        requests = [(f"api: {route}", api, "GET", route, None) for route in API_ROUTES]
+
+        # The largest JavaScript file on the page, fingerprinted so compressed once and cached
+        page = dash.get("/").text
+        scripts = [part.split('"')[0] for part in page.split('<script src="')[1:]]
+        sizes = {s: len(dash.get(s, headers={"Accept-Encoding": "identity"}).content) for s in scripts}
+        requests.append(("dash: largest script", dash, "GET", max(sizes, key=sizes.get), None))
+        requests += [(f"dash: {route}", dash, "GET", route, None)
+                     for route in ("/", "/_dash-layout", "/_dash-dependencies")]
+
+        dependencies = dash.get("/_dash-dependencies").json()
+        for name, input_id, prop, value in DASH_CALLBACKS:
+            dependency = next(d for d in dependencies if d["inputs"][0]["id"] == input_id)
+            payload = {
+                "output": dependency["output"],
+                "outputs": callback_outputs(dependency["output"]),
+                "inputs": [{"id": input_id, "property": prop, "value": value}],
+                "changedPropIds": [f"{input_id}.{prop}"],
+                "state": [{**s, "value": None} for s in dependency["state"]],
+            }
+            requests.append((name, dash, "POST", "/_dash-update-component", payload))
+
+        for name, client, method, url, payload in requests:
+            results = [measure(client, method, url, e, repeat, payload) for e in ENCODINGS]
+            gzip_cpu, br_cpu = compress_cpu_ms(results[0][2])
+            rows.append((name, results, gzip_cpu, br_cpu))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--repeat", type=int, default=10, help="requests per route and encoding")
+    parser.add_argument("--api-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--dash-url", default="http://127.0.0.1:8050")
+    parser.add_argument("--start-servers", action="store_true",
+                        help="start the mock_api and Dash app locally for the benchmark")
+    args = parser.parse_args()
+
+    servers = start_servers(args.api_url, args.dash_url) if args.start_servers else []
+    try:
+        rows = benchmark(args.api_url, args.dash_url, args.repeat)
+    finally:
+        stop_servers(servers)
+
+    print(f"{'route':<26}{'identity B':>11}{'gzip B':>9}{'br B':>9}"
+          f"{'identity ms':>12}{'gzip ms':>9}{'br ms':>9}{'gzip cpu':>10}{'br cpu':>8}")
+    for name, results, gzip_cpu, br_cpu in rows:
+        sizes = "".join(f"{r[0]:>{w}}" for r, w in zip(results, (11, 9, 9)))
+        times = "".join(f"{r[1]:>{w}.1f}" for r, w in zip(results, (12, 9, 9)))
+        print(f"{name:<26}{sizes}{times}{gzip_cpu:>10.2f}{br_cpu:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+""" Benchmark of the mock_api table routes for databases with many tables.
+
+Compares the current routes, which take the table name as a path parameter (/{table_name}), with
+the previous design that registered four routes for every table (/games, /games/search, ...).
+
+For each number of tables a temporary database is created and the following are reported:
+
+- startup: ms to create ParalympicsData and the FastAPI app with its routes
+- openapi: ms to generate the OpenAPI schema (done when /docs or /openapi.json is first requested),
+  and its size in KB
+- match: µs for Starlette to find the route for a request to the last table, the worst case as
+  routes are checked in order
+- request: mean ms for a GET /<table>/1 request to the last table, sent in-process (no network)
+
+The benchmark needs httpx, install it with:
+
+    pip install -e .[loadtest]
+
+Usage (run from the project root):
+
+    python -m src.loadtest.routing --tables 10 100 500
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from starlette.routing import Match
+
+from src.data import mock_api
+from src.data.data import ParalympicsData
+
+
+def create_database(database_file: Path, n_tables: int, n_rows: int = 10):
+    """ Creates a database with n_tables tables named t0, t1, ..., each with n_rows rows """
+    conn = sqlite3.connect(database_file)
+    try:
+        for t in range(n_tables):
+            conn.execute(f"CREATE TABLE t{t} (id INTEGER PRIMARY KEY, name TEXT, value INTEGER)")
+            conn.executemany(f"INSERT INTO t{t} (name, value) VALUES (?, ?)",
+                             [(f"row {r}", r) for r in range(n_rows)])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def per_table_app(database_file: Path) -> FastAPI:
+    """ Returns an app with four routes for each table, as the mock_api used to create them """
+    data = ParalympicsData(database_file=database_file)
+    app = FastAPI()
+
+    def make_get_all(table_name: str) -> Callable:
+        async def _route():
+            return data.get_table_as_json(table_name)
+        return _route
+
+    def make_get_by_id(table_name: str) -> Callable:
+        async def _route(item_id: int):
+            row = data.get_row_by_id(table_name, item_id)
+            if row is None:
+                raise HTTPException(status_code=404, detail="Item not found")
+            return row
+        return _route
+
+    def make_search(table_name: str) -> Callable:
+        async def _route(request: Request):
+            return data.search_table(table_name, dict(request.query_params))
+        return _route
+
+    def make_post(table_name: str) -> Callable:
+        async def _route(request: Request):
+            return data.add_row(table_name, await request.json())
+        return _route
+
+    for t in data.tables:
+        app.get(f"/{t}", name=f"{t}_all")(make_get_all(t))
+        app.get(f"/{t}/search", name=f"{t}_search")(make_search(t))
+        app.get(f"/{t}/{{item_id}}", name=f"{t}_get")(make_get_by_id(t))
+        app.post(f"/{t}", name=f"{t}_post")(make_post(t))
+    return app
+
+
+def parameterized_app(database_file: Path) -> FastAPI:
+    """ Returns the mock_api app, loaded again so that it uses database_file """
+    os.environ["PARALYMPICS_DATABASE"] = str(database_file)
+    try:
+        return importlib.reload(mock_api).app
+    finally:
+        del os.environ["PARALYMPICS_DATABASE"]
+
+
+def match_us(app: FastAPI, path: str, repeat: int = 2000) -> float:
+    """ Returns the time in µs for the app's router to find the route for a GET request to path """
+    scope = {"type": "http", "method": "GET", "path": path, "root_path": "", "headers": []}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for route in app.router.routes:
+            if route.matches(scope)[0] == Match.FULL:
+                break
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+async def request_ms(app: FastAPI, path: str, repeat: int = 200) -> float:
+    """ Returns the mean time in ms for a GET request to path, sent to the app in-process """
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        (await client.get(path)).raise_for_status()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await client.get(path)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def benchmark(n_tables: int) -> List[Dict]:
+    """ Returns the results for each design with a database of n_tables tables """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        database_file = Path(tmp) / "benchmark.db"
+        create_database(database_file, n_tables)
+        path = f"/t{n_tables - 1}/1"
+        for name, make_app in (("per-table", per_table_app), ("parameterized", parameterized_app)):
+            start = time.perf_counter()
+            app = make_app(database_file)
+            startup = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            schema = app.openapi()
+            openapi = (time.perf_counter() - start) * 1000
+            results.append({
+                "design": name,
+                "routes": len(app.router.routes),
+                "startup": startup,
+                "openapi": openapi,
+                "openapi_kb": len(json.dumps(schema)) / 1024,
+                "match": match_us(app, path),
+                "request": asyncio.run(request_ms(app, path)),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--tables", type=int, nargs="+", default=[10, 100, 500],
+                        help="numbers of tables to benchmark")
+    args = parser.parse_args()
+
+    print(f"{'tables':>6}  {'design':<14}{'routes':>7}{'startup ms':>11}{'openapi ms':>11}"
+          f"{'openapi KB':>11}{'match µs':>10}{'request ms':>11}")
+    for n_tables in args.tables:
+        for r in benchmark(n_tables):
+            print(f"{n_tables:>6}  {r['design']:<14}{r['routes']:>7}{r['startup']:>11.1f}"
+                  f"{r['openapi']:>11.1f}{r['openapi_kb']:>11.1f}{r['match']:>10.1f}{r['request']:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,16 @@
 """ Note to students: at 400 lines this is not a good example of how to structure code for readability. """
+import os
 from typing import List
 import dash
 import dash_bootstrap_components as dbc
-import requests
-from dash import Input, Output, State, dcc, html
+from dash import Input, Output, Patch, State, dcc, html
 from dash.exceptions import PreventUpdate
 
-from paralympics import charts
+from paralympics import background, charts, compression, datasource, profiling
+from paralympics.profiling import phase
 
-API_BASE_URL = "http://127.0.0.1:8000/"
+API_BASE_URL = "http://127.0.0.1:8000"
+BAR_EVENT_TYPES = ["winter", "summer"]
 
 # --- APP INSTANCE AND CONFIG ---
 app = dash.Dash(
@@ -23,6 +25,17 @@ app = dash.Dash(
 # Prevents issues where callbacks rely on an id that is not present in the layout when the app runs
 app.config.suppress_callback_exceptions = True
 
+# Compress responses with brotli or gzip
+compression.enable_compression(app)
+
+# Get the data from the API (caching responses until the API reports a change to the data), or
+# directly from the database, see datasource.py
+data_source = datasource.from_env(API_BASE_URL)
+datasource.configure(data_source)
+
+# Opt-in, run the chart callbacks as background jobs, see background.py. None when not enabled.
+background_manager = background.manager_from_env()
+
 
 # --- HELPER FUNCTIONS ---
 def create_linechart_select():
@@ -45,10 +58,8 @@ def create_barchart_checklist():
         [
             dbc.Label("Choose one or both options"),
             dbc.Checklist(
-                options=[
-                    {"label": "Winter", "value": "winter"},
-                    {"label": "Summer", "value": "summer"},
-                ],
+                options=[{"label": event_type.title(), "value": event_type}
+                         for event_type in BAR_EVENT_TYPES],
                 value=[],
                 id="checklist-barchart",
                 inline=True,
@@ -59,25 +70,22 @@ def create_barchart_checklist():
 
 def get_number_questions():
     """ Helper to get the number of questions available"""
-    q_resp = requests.get(f"{API_BASE_URL}/question", timeout=2)
-    q_resp.raise_for_status()
-    questions = q_resp.json()
+    with phase("api"):
+        questions = data_source.get_table("question")
     return len(questions)
 
 
 def get_question(qid: int):
     """ Helper to get the question"""
-    q_resp = requests.get(f"{API_BASE_URL}/question/{qid}", timeout=2)
-    q_resp.raise_for_status()
-    q = q_resp.json()
+    with phase("api"):
+        q = data_source.get_row("question", qid)
     return q
 
 
 def get_responses(qid: int):
     """ Helper to get the questions and responses for a given question id"""
-    r_resp = requests.get(f"{API_BASE_URL}/response/search?question_id={qid}", timeout=2)
-    r_resp.raise_for_status()
-    r = r_resp.json()
+    with phase("api"):
+        r = data_source.search_table("response", {"question_id": qid})
     return r
 
 
@@ -177,7 +185,12 @@ row_one = dbc.Row(children=[
         html.Div(children=[], id="selectors")
         # A div to add the extra selectors dependent on chart-type
     ], width=4),
-    dbc.Col(html.Div("", id="chart-display"), width=8),
+    dbc.Col(children=[
+        # Shows the progress of the chart callbacks when they run in the background
+        dbc.Progress(id="chart-progress", value=0, striped=True, animated=True,
+                     style={"visibility": "hidden"}),
+        html.Div("", id="chart-display"),
+    ], width=8),
 ])
 
 row_two = dbc.Row(children=[
@@ -215,6 +228,9 @@ question_form = html.Div(children=[
 # --- LAYOUT ---
 app.layout = dbc.Container(children=[
     navbar,
+    # The browser copies each table-change event from the API into the table-changes store
+    dcc.Store(id="events-url", data=data_source.events_url),
+    dcc.Store(id="table-changes", storage_type="memory"),
     dbc.Tabs([
         dbc.Tab(label='Paralympics dashboard and questions', children=[
             lead,
@@ -230,15 +246,21 @@ app.layout = dbc.Container(children=[
 
 
 # --- CALLBACKS ---
-@app.callback(
-    Output("chart-display", "children", allow_duplicate=True),
+@background.chart_callback(
+    app, background_manager,
+    Output("chart-display", "children"),
     Output("selectors", "children"),
     Input("select-chart", "value"),
+    progress_id="chart-progress",
 )
-def update_chart_display(chart_type):
+def update_chart_display(set_progress, chart_type):
     """ Updates the chart display and selectors based on the selected chart-type
 
+    The line and bar chart graphs are created here, hidden and empty. The selector callbacks then
+    update these graphs in place rather than replacing them, so they only send what has changed.
+
     Args:
+        set_progress (function): sets the value of the progress bar, see background.chart_callback
         chart_type (str): one of "line", "map", "bar" else empty
 
     Returns:
@@ -255,11 +277,20 @@ def update_chart_display(chart_type):
     if chart_type == "line":
         line_select = create_linechart_select()
         selectors.append(line_select)
+        graphs.append(dcc.Graph(figure={}, id="line-chart", style={"display": "none"}))
+        # The feature and traces currently in the line chart
+        graphs.append(dcc.Store(id="line-chart-state", data=None))
     elif chart_type == "bar":
         barchart_checklist = create_barchart_checklist()
         selectors.append(barchart_checklist)
+        for event_type in BAR_EVENT_TYPES:
+            graphs.append(dcc.Graph(figure={}, id=f"{event_type}-barchart", style={"display": "none"}))
+        # The event types that already have a bar chart figure
+        graphs.append(dcc.Store(id="barchart-built", data=[]))
     elif chart_type == "map":
+        set_progress(10)
         figure = charts.scatter_map()
+        set_progress(90)
         graphs.append(dcc.Graph(figure=figure, id="scatter-map"))
     else:
         raise dash.exceptions.PreventUpdate
@@ -267,44 +298,95 @@ def update_chart_display(chart_type):
     return graphs, selectors
 
 
-@app.callback(
-    Output("chart-display", "children", allow_duplicate=True),
-    [Input("line-select", "value")],
+@background.chart_callback(
+    app, background_manager,
+    Output("line-chart", "figure"),
+    Output("line-chart", "style"),
+    Output("line-chart-state", "data"),
+    Input("line-select", "value"),
+    State("line-chart-state", "data"),
+    progress_id="chart-progress",
+    cancel_id="select-chart",
 )
-def display_line_chart(selected_value):
-    """ Takes the selected feature and displays the line chart """
+def display_line_chart(set_progress, selected_value, chart_state):
+    """ Takes the selected feature and displays the line chart
+
+    The first time, the whole figure is sent. After that only the data and labels of the traces are
+    sent as a partial update (dash.Patch), as the rest of the figure stays the same.
+
+    Args:
+        set_progress (function): sets the value of the progress bar, see background.chart_callback
+        selected_value (str): the feature to display
+        chart_state (dict): the feature and traces (name and type) currently in the chart, or None
+
+    Returns:
+        figure (go.Figure or Patch), style (dict or Patch), chart_state (dict)
+    """
     if not selected_value:
         raise dash.exceptions.PreventUpdate
 
-    graph = dcc.Graph(figure=charts.line_chart(selected_value),
-                      id=f"{selected_value}-chart")
-    return graph
-
+    set_progress(10)
+    fig = charts.line_chart(selected_value)
+    set_progress(90)
+    traces = [[trace.name, trace.type] for trace in fig.data]
+    new_state = {"feature": selected_value, "traces": traces}
+    if not chart_state or chart_state["traces"] != traces:
+        return fig, {"display": "block"}, new_state
+    if chart_state["feature"] == selected_value:
+        raise dash.exceptions.PreventUpdate
 
-@app.callback(
-    Output("chart-display", "children"),
-    [Input("checklist-barchart", "value")],
+    patch = Patch()
+    for i, trace in enumerate(fig.data):
+        patch["data"][i]["x"] = trace.x
+        patch["data"][i]["y"] = trace.y
+        patch["data"][i]["hovertemplate"] = trace.hovertemplate
+    patch["layout"]["yaxis"]["title"]["text"] = fig.layout.yaxis.title.text
+    return patch, dash.no_update, new_state
+
+
+@background.chart_callback(
+    app, background_manager,
+    [Output(f"{event_type}-barchart", "figure") for event_type in BAR_EVENT_TYPES],
+    [Output(f"{event_type}-barchart", "style") for event_type in BAR_EVENT_TYPES],
+    Output("barchart-built", "data"),
+    Input("checklist-barchart", "value"),
+    State("barchart-built", "data"),
+    progress_id="chart-progress",
+    cancel_id="select-chart",
 )
-def display_bar_chart(event_types):
-    """ Takes the selected Paralympics type(s) and displays the bar chart(s)
+def display_bar_chart(set_progress, event_types, built):
+    """ Takes the selected Paralympics type(s) and shows or hides the bar chart(s)
+
+    Each bar chart figure is only created and sent the first time its type is selected. After that
+    ticking or unticking a type only changes whether its graph is displayed (a dash.Patch of the
+    style).
 
     Args:
+        set_progress (function): sets the value of the progress bar, see background.chart_callback
         event_types (List[str]): one or both of 'winter', 'summer'
+        built (List[str]): the event types that already have a figure
 
     Returns:
-        graphs (list): List of chart components
+        a figure for each of BAR_EVENT_TYPES, then a style for each, then the updated built list
     """
-    if not event_types:
-        raise dash.exceptions.PreventUpdate
-
-    graphs = []
-
-    for event_type in event_types:
-        graph = dcc.Graph(figure=charts.bar_chart(event_type),
-                          id=f"{event_type}-barchart")
-        graphs.append(graph)
-
-    return graphs
+    event_types = event_types or []
+    built = built or []
+    figures = []
+    styles = []
+
+    set_progress(10)
+    for i, event_type in enumerate(BAR_EVENT_TYPES, start=1):
+        style = Patch()
+        style["display"] = "block" if event_type in event_types else "none"
+        styles.append(style)
+        if event_type in event_types and event_type not in built:
+            figures.append(charts.bar_chart(event_type))
+            built = built + [event_type]
+        else:
+            figures.append(dash.no_update)
+        set_progress(10 + 80 * i // len(BAR_EVENT_TYPES))
+
+    return *figures, *styles, built
 
 
 @app.callback(
@@ -399,6 +481,51 @@ def render_question(index):
     return create_question(q)
 
 
+app.clientside_callback(
+    """
+    function (url) {
+        // Open one connection to the API's table-change events for the page
+        if (!url || window.paralympicsEvents) {
+            return window.dash_clientside.no_update;
+        }
+        window.paralympicsEvents = new EventSource(url);
+        window.paralympicsEvents.addEventListener("table-change", function (e) {
+            window.dash_clientside.set_props("table-changes", {data: JSON.parse(e.data)});
+        });
+        return window.dash_clientside.no_update;
+    }
+    """,
+    Output("table-changes", "data"),
+    Input("events-url", "data"),
+    prevent_initial_call=False,
+)
+
+
+@app.callback(
+    Output("question", "children", allow_duplicate=True),
+    Input("table-changes", "data"),
+    State("q_index", "data"),
+)
+def refresh_question(change, index):
+    """ Renders the current question again if it, or one of its responses, has changed
+
+    Args:
+        change (dict): the latest table-change event from the API, with the table name and row
+        index (int): the question id
+
+    Returns:
+        question (html.Div): the question component
+    """
+    if not change or not index:
+        raise PreventUpdate
+    row = change.get("row") or {}
+    if change.get("table") == "question" and row.get("id") == index:
+        return render_question(index)
+    if change.get("table") == "response" and row.get("question_id") == index:
+        return render_question(index)
+    raise PreventUpdate
+
+
 @app.callback(
     Output("form-message", "children"),
     Input("new-question-submit-button", "n_clicks"),
@@ -443,25 +570,32 @@ def process_question_form(n_clicks, question_text, *states):
     if errors:
         return errors
 
-    # Use the API to save the question to the database
+    # Save the question to the database, using the API unless the data source is local
     payload = question
     try:
-        response = requests.post(f"{API_BASE_URL}/question", json=payload)
-        response.raise_for_status()
+        with phase("api"):
+            new_question = data_source.add_row("question", payload)
 
-        # Get the id of the newly saved question from the response
-        question_id = response.json()["id"]
+            # Get the id of the newly saved question
+            question_id = new_question["id"]
 
-        for idx, r in enumerate(responses, start=1):
-            r["question_id"] = question_id
-            resp = requests.post(f"{API_BASE_URL}/response", json=r)
-            resp.raise_for_status()
+            for idx, r in enumerate(responses, start=1):
+                r["question_id"] = question_id
+                data_source.add_row("response", r)
         return "Question saved successfully."
 
     except Exception as exc:
         return html.P(f"Error saving question: {exc}")
 
 
+# --- PROFILING ---
+# Opt-in, see profiling.py. Must come after all the callbacks have been registered.
+if os.environ.get("PARALYMPICS_PROFILE"):
+    profiling.instrument(
+        app,
+        top_n=int(os.environ.get("PARALYMPICS_PROFILE_TOP", "0")),
+        profile_dir=os.environ.get("PARALYMPICS_PROFILE_DIR"),
+    )
 
 # Run the app
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+""" Opt-in background execution of the chart callbacks.
+
+By default the chart callbacks run in the Dash request thread, so a slow chart build keeps that
+worker busy until it finishes. To run them as Dash background callbacks instead, set the
+PARALYMPICS_BACKGROUND_CALLBACKS environment variable before starting the app, e.g.
+
+    PARALYMPICS_BACKGROUND_CALLBACKS=1 python src/paralympics/app.py
+
+This needs the extra dependencies for Dash's DiskcacheManager, install them with:
+
+    pip install -e .[background]
+
+The jobs run in a separate process and their progress and results are stored in a diskcache
+directory (no external service such as Redis or Celery is needed). Set PARALYMPICS_CALLBACK_CACHE_DIR
+to choose the directory, the default is paralympics-callbacks in the system temporary directory.
+
+When enabled:
+
+- the progress bar below the chart shows the progress of the job
+- a job is cancelled if the user chooses a different chart before it finishes
+- results are cached, keyed on the callback inputs and the version of the API data (see
+  cache.generation), so the same chart is only built once until the data changes
+"""
+import functools
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from dash import Input, Output
+
+from paralympics import cache
+
+# Seconds that an unused cached result is kept for
+RESULT_EXPIRE = 600
+
+_PROGRESS_VISIBLE = {"visibility": "visible"}
+_PROGRESS_HIDDEN = {"visibility": "hidden"}
+
+
+def create_manager(cache_dir: Optional[str] = None, expire: int = RESULT_EXPIRE):
+    """ Returns a DiskcacheManager for the background callbacks
+
+    Args:
+        cache_dir (str): directory for the diskcache, defaults to paralympics-callbacks in the
+            system temporary directory
+        expire (int): seconds that an unused cached result is kept for
+
+    Returns:
+        manager (dash.DiskcacheManager)
+
+    Raises:
+        ImportError: if diskcache, multiprocess or psutil are not installed
+    """
+    # Imported here as these are optional dependencies, only needed when background callbacks are used
+    import diskcache  # pylint: disable=import-outside-toplevel
+    from dash import DiskcacheManager  # pylint: disable=import-outside-toplevel
+
+    if cache_dir is None:
+        cache_dir = str(Path(tempfile.gettempdir()) / "paralympics-callbacks")
+    return DiskcacheManager(diskcache.Cache(cache_dir), cache_by=[cache.generation], expire=expire)
+
+
+def manager_from_env():
+    """ Returns a DiskcacheManager if PARALYMPICS_BACKGROUND_CALLBACKS is set, otherwise None """
+    if not os.environ.get("PARALYMPICS_BACKGROUND_CALLBACKS"):
+        return None
+    return create_manager(os.environ.get("PARALYMPICS_CALLBACK_CACHE_DIR"))
+
+
+def _no_progress(*_args):
+    """ Stands in for set_progress when the callback is not run in the background """
+
+
+def chart_callback(app, manager, *dependencies, progress_id: str, cancel_id: Optional[str] = None,
+                   **kwargs):
+    """ Decorator that registers a chart callback, as a background callback if there is a manager
+
+    The decorated function must take set_progress as its first argument, followed by the values of
+    the Inputs and States, as for a Dash background callback with progress. set_progress(value)
+    sets the value (0 to 100) of the progress bar. When there is no manager the callback runs in
+    the request thread as usual and set_progress does nothing.
+
+    Args:
+        app (dash.Dash): the Dash app
+        manager (dash.DiskcacheManager): the manager, or None to not run the callback in the background
+        dependencies: the Outputs, Inputs and States, as for app.callback
+        progress_id (str): id of the dbc.Progress bar, shown while the job is running
+        cancel_id (str): id of a component whose value cancels the job when it changes
+        kwargs: other keyword arguments for app.callback
+
+    Example:
+        @chart_callback(app, manager, Output("chart", "figure"), Input("select", "value"),
+                        progress_id="chart-progress")
+        def update_chart(set_progress, value):
+            ...
+    """
+    def decorator(func):
+        if manager is None:
+            @functools.wraps(func)
+            def inline(*args):
+                return func(_no_progress, *args)
+
+            app.callback(*dependencies, **kwargs)(inline)
+            return func
+
+        return app.callback(
+            *dependencies,
+            background=True,
+            manager=manager,
+            progress=Output(progress_id, "value"),
+            running=[(Output(progress_id, "style"), _PROGRESS_VISIBLE, _PROGRESS_HIDDEN)],
+            cancel=[Input(cancel_id, "value")] if cancel_id else None,
+            **kwargs,
+        )(func)
+
+    return decorator
@@ -0,0 +1,123 @@
+""" Cache of the JSON returned by GET requests to the mock_api.
+
+The mock_api sends a 'table-change' event on its /events stream whenever a row is added. A
+background thread listens to the stream and removes only the cached responses that used the
+changed table, so unchanged data is never requested again.
+
+Responses are only cached while the listener is connected. If the connection drops the cache is
+emptied, since changes could have been missed, and it is used again once the listener reconnects.
+"""
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import requests
+
+# Tables joined by the /all route
+ALL_DATA_TABLES = {"games", "games_host", "host", "country"}
+
+_cache: Dict[str, Tuple[Set[str], object]] = {}
+_lock = threading.Lock()
+_generation = 0  # increases whenever anything is removed from the cache
+_connected = threading.Event()
+_listener: Optional[threading.Thread] = None
+
+
+def tables_for_url(url: str) -> Set[str]:
+    """ Returns the names of the tables the response from an API URL comes from
+
+    e.g. http://127.0.0.1:8000/response/search?question_id=1 -> {"response"}
+    """
+    table_name = urlsplit(url).path.strip("/").split("/")[0]
+    if table_name == "all":
+        return set(ALL_DATA_TABLES)
+    return {table_name}
+
+
+def get_json(url: str, timeout: Optional[float] = None):
+    """ Returns the JSON from a GET request to the API, using the cached response if there is one
+
+    Args:
+        url (str): the API URL
+        timeout (float): request timeout in seconds
+
+    Returns:
+        data: the decoded JSON, this is shared with other callers so must not be changed
+
+    Raises:
+        requests.HTTPError: if the response status is an error
+    """
+    with _lock:
+        if url in _cache:
+            return _cache[url][1]
+        request_generation = _generation
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    with _lock:
+        # Don't cache the response if the table changed while it was being requested
+        if _connected.is_set() and request_generation == _generation:
+            _cache[url] = (tables_for_url(url), data)
+    return data
+
+
+def generation() -> int:
+    """ Returns a number that increases whenever cached data is removed, i.e. when the data may have changed """
+    return _generation
+
+
+def invalidate(table_name: Optional[str] = None):
+    """ Removes the cached responses that use a table, or all cached responses if table_name is None """
+    global _generation
+    with _lock:
+        _generation += 1
+        for url in [u for u, (tables, _) in _cache.items() if table_name is None or table_name in tables]:
+            del _cache[url]
+
+
+def _reset_after_fork():
+    """ Gives a forked process (e.g. a background callback job) its own lock, and stops it caching
+
+    The listener thread is not copied to the new process, so it would not hear about changes.
+    """
+    global _lock, _connected
+    _lock = threading.Lock()
+    _connected = threading.Event()
+
+
+# Not available on Windows, which doesn't fork processes
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def start_listener(api_base_url: str):
+    """ Starts the background thread that listens to the API's /events stream, if not already started
+
+    Args:
+        api_base_url (str): e.g. http://127.0.0.1:8000
+    """
+    global _listener
+    if _listener is None:
+        _listener = threading.Thread(target=_listen, args=(f"{api_base_url}/events",), daemon=True,
+                                     name="api-events")
+        _listener.start()
+
+
+def _listen(events_url: str):
+    while True:
+        try:
+            with requests.get(events_url, stream=True, timeout=(2, 60)) as response:
+                response.raise_for_status()
+                invalidate()  # changes may have been missed while not connected
+                _connected.set()
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith("data:"):
+                        invalidate(json.loads(line[len("data:"):])["table"])
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+        _connected.clear()
+        invalidate()
+        time.sleep(3)
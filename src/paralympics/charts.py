@@ -1,33 +1,130 @@
+import numpy as np
 import pandas as pd
 import plotly
 import plotly.express as px
-import requests
 
+from paralympics import datasource
+from paralympics.profiling import phase
 
-def get_api_data(url) -> pd.DataFrame:
-    """ Gets the JSON data from the mock_api REST API
+# Limits that keep the figures fast to draw and small to send to the browser for large datasets
+WEBGL_THRESHOLD = 1000  # line charts with more points than this are drawn with WebGL (Scattergl)
+MAX_LINE_POINTS = 2000  # lines with more points than this are downsampled, see lttb_indices
+MAX_MAP_POINTS = 500  # maps with more points than this show clusters of nearby points
 
-    Args:
-        url: URL for the REST API route, e.g. http://127.0.0.1:8000/all
+
+def get_api_data() -> pd.DataFrame:
+    """ Gets the data for the charts, the same data as the mock_api /all route
+
+    The data comes from the configured data source, either the REST API or the database directly,
+    see datasource.py
 
     Returns:
         df: DataFrame with the data
     """
-    response = requests.get(url)
-    response.raise_for_status()
-    data = response.json()
-    df = pd.DataFrame(data)
+    with phase("api"):
+        data = datasource.get_source().get_all_data()
+    with phase("transform"):
+        df = pd.DataFrame(data)
     return df
 
 
-def line_chart(feature) -> plotly.graph_objects.Figure:
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """ Chooses which points of a line to keep using Largest-Triangle-Three-Buckets downsampling
+
+    The first and last points are kept. The points in between are split into n_out - 2 buckets and
+    from each bucket the point that makes the largest triangle with the previously kept point and
+    the average of the next bucket is kept. This keeps the peaks and troughs that a simple 'every
+    nth point' would miss.
+
+    Args:
+        x (np.ndarray): x values, in ascending order
+        y (np.ndarray): y values, without NaN
+        n_out (int): number of points to keep
+
+    Returns:
+        indices (np.ndarray): positions of the points to keep, in ascending order
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    kept = [0]
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        a = kept[-1]
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        kept.append(start + int(np.argmax(area)))
+    kept.append(n - 1)
+    return np.array(kept)
+
+
+def downsample_lines(df: pd.DataFrame, x: str, y: str, color: str, max_points: int) -> pd.DataFrame:
+    """ Downsamples each line (one per value of the color column) that has more than max_points
+
+    Args:
+        df (pd.DataFrame): the chart data
+        x (str): column for the x-axis
+        y (str): column for the y-axis
+        color (str): column that splits the data into lines
+        max_points (int): maximum points per line
+
+    Returns:
+        df (pd.DataFrame): the chart data with at most max_points per line
+    """
+    parts = []
+    for _, line in df.groupby(color, sort=False):
+        if len(line) > max_points:
+            line = line.dropna(subset=[y]).sort_values(x)
+            keep = lttb_indices(line[x].to_numpy(dtype=float), line[y].to_numpy(dtype=float),
+                                max_points)
+            line = line.iloc[keep]
+        parts.append(line)
+    return pd.concat(parts) if parts else df
+
+
+def cluster_points(df: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    """ Groups points that are close together so that the map has at most max_points markers
+
+    Points are grouped by the grid square they are in, starting with 0.5 degree squares and
+    doubling the size until there are few enough groups. Each group is shown at the mean position
+    of its points and named after its first point and the number of others.
+
+    Args:
+        df (pd.DataFrame): data with latitude, longitude and name columns
+        max_points (int): maximum number of markers
+
+    Returns:
+        df (pd.DataFrame): latitude, longitude, name and count (of points in the group)
+    """
+    df = df.dropna(subset=["latitude", "longitude"])
+    cell = 0.5
+    while True:
+        keys = [(df["latitude"] // cell).astype(int), (df["longitude"] // cell).astype(int)]
+        if df.groupby(keys).ngroups <= max_points or cell >= 180:
+            break
+        cell *= 2
+    clusters = df.groupby(keys).agg(latitude=("latitude", "mean"), longitude=("longitude", "mean"),
+                                    name=("name", "first"), count=("name", "size"))
+    clusters["name"] = clusters["name"].where(
+        clusters["count"] == 1, clusters["name"] + " and " + (clusters["count"] - 1).astype(str) + " more")
+    return clusters.reset_index(drop=True)
+
+
+def line_chart(feature, render_mode="auto", max_points=MAX_LINE_POINTS) -> plotly.graph_objects.Figure:
     """ Creates a line chart with data from the mock_api
 
     Data is displayed over time from 1960 onwards.
     The figure shows separate trends for the winter and summer events.
 
+    For large datasets each line is downsampled to at most max_points, and the chart is drawn with
+    WebGL instead of SVG when it has more than WEBGL_THRESHOLD points.
+
      Args:
         feature (str): events, sports, countries, participants
+        render_mode (str): "auto" to use WebGL for large datasets, "svg" or "webgl" to choose
+        max_points (int): maximum points per line, None to not downsample
 
      Returns:
         fig: Plotly Express line figure
@@ -39,45 +136,65 @@ def line_chart(feature) -> plotly.graph_objects.Figure:
     else:
         feature = feature.lower()
 
-    df = get_api_data("http://127.0.0.1:8000/all")
-
-    chart_df = df[["event_type", "year", feature]]
-
-    fig = px.line(chart_df,
-                  x="year",
-                  y=feature,
-                  color="event_type",
-                  # title=f"How has the number of {feature} changed over time?",
-                  template="simple_white")
+    df = get_api_data()
+
+    with phase("transform"):
+        chart_df = df[["event_type", "year", feature]]
+        if max_points:
+            chart_df = downsample_lines(chart_df, "year", feature, "event_type", max_points)
+        if render_mode == "auto":
+            render_mode = "webgl" if len(chart_df) > WEBGL_THRESHOLD else "svg"
+
+    with phase("figure"):
+        fig = px.line(chart_df,
+                      x="year",
+                      y=feature,
+                      color="event_type",
+                      # title=f"How has the number of {feature} changed over time?",
+                      render_mode=render_mode,
+                      template="simple_white")
     return fig
 
 
-def scatter_map():
+def scatter_map(max_points=MAX_MAP_POINTS):
     """ Creates a scatter chart with locations of all Paralympics
 
+    The map is already drawn with WebGL. When there are more than max_points locations, nearby
+    locations are shown as one marker sized by the number of locations, see cluster_points.
+
+    Args:
+        max_points (int): maximum number of markers, None to show every location
+
     Returns:
         fig: Plotly Express scatter map figure
     """
 
-    df = get_api_data("http://127.0.0.1:8000/all")
+    df = get_api_data()
+
+    with phase("transform"):
+        chart_df = df[["year", "place_name", "latitude", "longitude"]].copy()
 
-    chart_df = df[["year", "place_name", "latitude", "longitude"]].copy()
+        # Ensure latitude/longitude are numeric (non-numeric -> NaN)
+        chart_df['longitude'] = pd.to_numeric(chart_df['longitude'], errors='coerce')
+        chart_df['latitude'] = pd.to_numeric(chart_df['latitude'], errors='coerce')
 
-    # Ensure latitude/longitude are numeric (non-numeric -> NaN)
-    chart_df['longitude'] = pd.to_numeric(chart_df['longitude'], errors='coerce')
-    chart_df['latitude'] = pd.to_numeric(chart_df['latitude'], errors='coerce')
+        # Add a new column that concatenates the place_name and year e.g. Barcelona 2012
+        chart_df['name'] = chart_df['place_name'] + ' ' + chart_df['year'].astype(str)
 
-    # Add a new column that concatenates the place_name and year e.g. Barcelona 2012
-    chart_df['name'] = chart_df['place_name'] + ' ' + chart_df['year'].astype(str)
+        clustered = bool(max_points) and len(chart_df) > max_points
+        if clustered:
+            chart_df = cluster_points(chart_df, max_points)
 
     # Create the figure
-    fig = px.scatter_map(chart_df,
-                         lat=chart_df.latitude,
-                         lon=chart_df.longitude,
-                         hover_name=chart_df.name,
-                         zoom=0.5
-                         # title="Where have the paralympics been held?"
-                         )
+    with phase("figure"):
+        fig = px.scatter_map(chart_df,
+                             lat=chart_df.latitude,
+                             lon=chart_df.longitude,
+                             hover_name=chart_df.name,
+                             size=chart_df["count"] if clustered else None,
+                             zoom=0.5
+                             # title="Where have the paralympics been held?"
+                             )
     return fig
 
 
@@ -91,31 +208,33 @@ def bar_chart(event_type):
     Returns
     fig: Plotly Express bar chart
     """
-    df = get_api_data("http://127.0.0.1:8000/all")
+    df = get_api_data()
     print(df.head())
-    needed = ['event_type', 'year', 'place_name', 'participants_m', 'participants_f',
-              'participants']
-    df_plot = (
-        df[needed]
-        .dropna(subset=['participants_m', 'participants_f'])
-        .query("event_type == @event_type")
-        .assign(  # Avoid divide-by-zero; if participants==0, set NaN, then drop
-            Male=lambda d: d['participants_m'].where(d['participants'] != 0, pd.NA) / d[
-                'participants'],
-            Female=lambda d: d['participants_f'].where(d['participants'] != 0, pd.NA) / d[
-                'participants'],
-            xlabel=lambda d: d['place_name'] + " " + d['year'].astype(str), )
-        .dropna(subset=['Male', 'Female'])
-        .sort_values(['event_type', 'year'])
-    )
-
-    fig = px.bar(df_plot,
-                 x='xlabel',
-                 y=['Male', 'Female'],
-                 # title=f'How has the ratio of female:male participants changed in the {event_type} paralympics?',
-                 labels={'xlabel': '', 'value': '', 'variable': ''},
-                 template="simple_white"
-                 )
-    fig.update_xaxes(ticklen=0)
-    fig.update_yaxes(tickformat=".0%")
+    with phase("transform"):
+        needed = ['event_type', 'year', 'place_name', 'participants_m', 'participants_f',
+                  'participants']
+        df_plot = (
+            df[needed]
+            .dropna(subset=['participants_m', 'participants_f'])
+            .query("event_type == @event_type")
+            .assign(  # Avoid divide-by-zero; if participants==0, set NaN, then drop
+                Male=lambda d: d['participants_m'].where(d['participants'] != 0, pd.NA) / d[
+                    'participants'],
+                Female=lambda d: d['participants_f'].where(d['participants'] != 0, pd.NA) / d[
+                    'participants'],
+                xlabel=lambda d: d['place_name'] + " " + d['year'].astype(str), )
+            .dropna(subset=['Male', 'Female'])
+            .sort_values(['event_type', 'year'])
+        )
+
+    with phase("figure"):
+        fig = px.bar(df_plot,
+                     x='xlabel',
+                     y=['Male', 'Female'],
+                     # title=f'How has the ratio of female:male participants changed in the {event_type} paralympics?',
+                     labels={'xlabel': '', 'value': '', 'variable': ''},
+                     template="simple_white"
+                     )
+        fig.update_xaxes(ticklen=0)
+        fig.update_yaxes(tickformat=".0%")
     return fig
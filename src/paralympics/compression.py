@@ -0,0 +1,61 @@
+""" Response compression for the Dash app, using Flask-Compress.
+
+Dash's own compress=True option only enables gzip. This enables brotli as well, and caches the
+compressed copies of the JavaScript and CSS files that Dash serves with a version fingerprint in the
+URL (e.g. dash_core_components.v3_2_0m1700000000.js). Those files never change for a URL, so each is
+only compressed once rather than once for every browser that loads the page.
+"""
+import threading
+from collections import OrderedDict
+
+from dash.fingerprint import check_fingerprint
+from flask import Request
+from flask_compress import Compress
+
+
+class _FingerprintCache:
+    """ Cache backend for Flask-Compress that only keeps the compressed fingerprinted files """
+
+    def __init__(self, max_items: int = 256):
+        self.max_items = max_items
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            return self._items.get(key)
+
+    def set(self, key: str, value: bytes):
+        if key.endswith(";"):  # not a fingerprinted file, see _cache_key
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+def _cache_key(request: Request) -> str:
+    """ Returns the URL of fingerprinted files, or "" for any other response so it is not cached """
+    if request.method == "GET" and check_fingerprint(request.path)[1]:
+        return request.path
+    return ""
+
+
+def enable_compression(app, minimum_size: int = 500, brotli_level: int = 4):
+    """ Compresses the Dash app's responses (layout, callback JSON, JavaScript, CSS)
+
+    Args:
+        app (dash.Dash): the Dash app
+        minimum_size (int): responses smaller than this number of bytes are sent uncompressed
+        brotli_level (int): brotli quality, 0 (fastest) to 11 (smallest)
+    """
+    app.server.config.update(
+        COMPRESS_ALGORITHM=["br", "gzip"],
+        COMPRESS_BR_LEVEL=brotli_level,
+        COMPRESS_MIN_SIZE=minimum_size,
+        COMPRESS_STREAMS=False,
+        COMPRESS_CACHE_KEY=_cache_key,
+        COMPRESS_CACHE_BACKEND=_FingerprintCache,
+    )
+    Compress(app.server)
@@ -0,0 +1,223 @@
+""" Where the Dash app gets its data from.
+
+By default the app gets the data from the mock_api REST API over HTTP. When the app and the API run
+on the same machine the app can instead read the paralympics.db database directly with
+ParalympicsData, which saves the HTTP request and the JSON encoding and decoding of every response.
+To do this set the PARALYMPICS_DATA_SOURCE environment variable before starting the app, e.g.
+
+    PARALYMPICS_DATA_SOURCE=local python src/paralympics/app.py
+
+PARALYMPICS_DATA_SOURCE can be "http" (the default) or "local". With "local" the
+PARALYMPICS_SNAPSHOT variable can also be set to read from an in-memory copy of the database, as
+for the mock_api.
+
+With "local", changes made to the database by other programs (e.g. a question added through the
+mock_api by another app) are found by checking the database every POLL_INTERVAL seconds, set by the
+PARALYMPICS_POLL_INTERVAL variable as for the mock_api. Cached chart results and the snapshot are
+then updated.
+"""
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+from urllib.parse import urlencode
+
+import requests
+
+from paralympics import cache
+
+# Seconds between checks for changes made to the database by other programs, see LocalDataSource
+POLL_INTERVAL = float(os.environ.get("PARALYMPICS_POLL_INTERVAL", "0.5"))
+
+_source: Optional["DataSource"] = None
+
+
+class DataSource(ABC):
+    """ The data the Dash app uses. Subclasses get it from the REST API or from the database.
+
+    Methods:
+        start(self): Starts watching for changes to the data, so cached data is not used once it changes
+        get_all_data(self): Returns the joined games, host and country data used by the charts
+        get_table(self, table_name): Returns all the rows of a table
+        get_row(self, table_name, item_id): Returns the row of a table with the primary key item_id
+        search_table(self, table_name, filters): Returns the rows of a table that match the filters
+        add_row(self, table_name, row): Adds a row to a table and returns the new row
+    """
+
+    # URL of the API's /events stream that the browser listens to for changes, None if there isn't one
+    events_url: Optional[str] = None
+
+    def start(self):
+        """ Starts watching for changes to the data """
+
+    @abstractmethod
+    def get_all_data(self) -> List[Dict]:
+        """ Returns the joined games, host and country data used by the charts """
+
+    @abstractmethod
+    def get_table(self, table_name: str) -> List[Dict]:
+        """ Returns all the rows of a table """
+
+    @abstractmethod
+    def get_row(self, table_name: str, item_id: int) -> Dict:
+        """ Returns the row of a table with the primary key item_id
+
+        Raises:
+            LookupError: if there is no row with that id
+        """
+
+    @abstractmethod
+    def search_table(self, table_name: str, filters: Dict) -> List[Dict]:
+        """ Returns the rows of a table where each column in filters equals its value """
+
+    @abstractmethod
+    def add_row(self, table_name: str, row: Dict) -> Dict:
+        """ Adds a row to a table and returns the new row, including its id """
+
+
+class HttpDataSource(DataSource):
+    """ Gets the data from the mock_api REST API.
+
+    GET responses are cached until the API reports a change to the data, see cache.py.
+
+    Attributes:
+        base_url: the API URL, e.g. http://127.0.0.1:8000
+        timeout: request timeout in seconds
+    """
+
+    def __init__(self, base_url: str, timeout: Optional[float] = 5):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.events_url = f"{self.base_url}/events"
+
+    def start(self):
+        cache.start_listener(self.base_url)
+
+    def get_all_data(self) -> List[Dict]:
+        return cache.get_json(f"{self.base_url}/all", timeout=self.timeout)
+
+    def get_table(self, table_name: str) -> List[Dict]:
+        return cache.get_json(f"{self.base_url}/{table_name}", timeout=self.timeout)
+
+    def get_row(self, table_name: str, item_id: int) -> Dict:
+        try:
+            return cache.get_json(f"{self.base_url}/{table_name}/{item_id}", timeout=self.timeout)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                raise LookupError(f"No {table_name} with id {item_id}") from e
+            raise
+
+    def search_table(self, table_name: str, filters: Dict) -> List[Dict]:
+        return cache.get_json(f"{self.base_url}/{table_name}/search?{urlencode(filters)}",
+                              timeout=self.timeout)
+
+    def add_row(self, table_name: str, row: Dict) -> Dict:
+        response = requests.post(f"{self.base_url}/{table_name}", json=row, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+class LocalDataSource(DataSource):
+    """ Reads and writes the paralympics.db database directly with ParalympicsData, in this process.
+
+    The rows are returned as Python dicts, so nothing is converted to or from JSON.
+
+    ParalympicsData's locks and connections can't be shared with a forked process (e.g. a background
+    callback job), since another thread may have been using them when the process was forked. A
+    forked process creates its own ParalympicsData the first time it uses the data.
+
+    Attributes:
+        data: the ParalympicsData instance
+    """
+
+    def __init__(self, snapshot: bool = False):
+        self.snapshot = snapshot
+        self._data = self._create_data()
+        self._watcher: Optional[threading.Thread] = None
+        # Not available on Windows, which doesn't fork processes
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _create_data(self):
+        # Imported here so the database is only needed when this data source is used
+        from data.data import ParalympicsData  # pylint: disable=import-outside-toplevel
+
+        return ParalympicsData(snapshot=self.snapshot)
+
+    def _reset_after_fork(self):
+        self._data = None
+        self._watcher = None  # the thread is not copied to the new process
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._create_data()
+        return self._data
+
+    def start(self):
+        # Rows added by this app or found by _watch_for_changes change the data, so results cached
+        # with cache.generation() are not reused
+        self.data.add_listener(lambda table_name, row: cache.invalidate(table_name))
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch_for_changes, daemon=True,
+                                             name="database-changes")
+            self._watcher.start()
+
+    def _watch_for_changes(self):
+        """ Regularly checks the database for changes made by other programs, as the mock_api does """
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                self.data.check_for_changes()
+            except RuntimeError:
+                pass  # e.g. the database was busy, try again next time
+
+    def get_all_data(self) -> List[Dict]:
+        return self.data.get_all_data()
+
+    def get_table(self, table_name: str) -> List[Dict]:
+        return self.data.get_table_as_json(table_name)
+
+    def get_row(self, table_name: str, item_id: int) -> Dict:
+        row = self.data.get_row_by_id(table_name, item_id)
+        if row is None:
+            raise LookupError(f"No {table_name} with id {item_id}")
+        return row
+
+    def search_table(self, table_name: str, filters: Dict) -> List[Dict]:
+        return self.data.search_table(table_name, filters)
+
+    def add_row(self, table_name: str, row: Dict) -> Dict:
+        return self.data.add_row(table_name, row)
+
+
+def from_env(api_base_url: str) -> DataSource:
+    """ Returns the data source chosen by the PARALYMPICS_DATA_SOURCE environment variable
+
+    Args:
+        api_base_url (str): the API URL for the "http" data source, e.g. http://127.0.0.1:8000
+
+    Raises:
+        ValueError: if PARALYMPICS_DATA_SOURCE is not "http" or "local"
+    """
+    kind = os.environ.get("PARALYMPICS_DATA_SOURCE", "http").lower()
+    if kind == "http":
+        return HttpDataSource(api_base_url)
+    if kind == "local":
+        return LocalDataSource(snapshot=bool(os.environ.get("PARALYMPICS_SNAPSHOT")))
+    raise ValueError(f"PARALYMPICS_DATA_SOURCE must be 'http' or 'local', not '{kind}'")
+
+
+def configure(source: DataSource):
+    """ Sets the data source used by the charts and the quiz, and starts it watching for changes """
+    global _source
+    _source = source
+    source.start()
+
+
+def get_source() -> DataSource:
+    """ Returns the data source set by configure(), by default the mock_api at http://127.0.0.1:8000 """
+    if _source is None:
+        configure(HttpDataSource("http://127.0.0.1:8000"))
+    return _source
@@ -0,0 +1,210 @@
+""" Opt-in profiling of the Dash callbacks.
+
+Profiling is off by default. To turn it on set the PARALYMPICS_PROFILE environment variable before
+starting the app, e.g.
+
+    PARALYMPICS_PROFILE=1 python src/paralympics/app.py
+
+When enabled every registered callback is timed and the wall time is broken down into phases:
+
+- api: time spent getting data from the data source, the REST API or the database (see datasource.py)
+- transform: pandas work to prepare the chart data
+- figure: building the Plotly figure
+- serialize: Dash converting the callback output (including any figures) to JSON
+
+The timings are added to each callback response as a Server-Timing header, so they can be seen in
+the browser developer tools (Network > Timing).
+
+Set PARALYMPICS_PROFILE_TOP to a number (e.g. 5) to also run the callbacks under cProfile and keep
+the profiles of the N slowest calls. Set PARALYMPICS_PROFILE_DIR to save them as .prof files when
+the app stops. The files can be viewed with `python -m pstats <file>` or a tool such as snakeviz.
+"""
+import atexit
+import cProfile
+import contextvars
+import functools
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import flask
+from dash import _callback as dash_callback
+
+PHASES = ("api", "transform", "figure", "serialize")
+
+# Timings for the request currently being handled, None when profiling is not active
+_timings: contextvars.ContextVar = contextvars.ContextVar("paralympics_timings", default=None)
+
+
+@contextmanager
+def phase(name: str):
+    """ Context manager that adds the time spent in the block to the named phase.
+
+    Does nothing unless profiling is enabled and a callback request is being handled.
+
+    Args:
+        name (str): one of PHASES
+
+    Example:
+        with phase("api"):
+            response = requests.get(url)
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+class CallbackProfiler:
+    """ Collects timings for the Dash callbacks.
+
+    Attributes:
+        top_n: number of cProfile profiles to keep, 0 to not run cProfile
+        stats: dict of callback name to the number of calls and total time per phase in seconds
+
+    Methods:
+        wrap(self, name, func): Returns func wrapped so that its calls are timed
+        report(self): Returns the stats as a list of dicts, slowest callback first
+        dump_profiles(self, directory): Saves the slowest profiles as .prof files
+    """
+
+    def __init__(self, top_n: int = 0):
+        self.top_n = top_n
+        self.stats: Dict[str, Dict[str, float]] = {}
+        self._slowest = []  # min-heap of (duration, sequence, callback name, profile)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        # cProfile can only profile one call at a time, other concurrent calls are only timed
+        self._profile_lock = threading.Lock()
+
+    def wrap(self, name: str, func: Callable) -> Callable:
+        """ Returns func wrapped so that its calls are timed and optionally profiled """
+
+        @functools.wraps(func)
+        def _timed(*args, **kwargs):
+            timings = _timings.get()
+            profile = None
+            if self.top_n and self._profile_lock.acquire(blocking=False):
+                profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                if profile:
+                    return profile.runcall(func, *args, **kwargs)
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                if profile:
+                    self._profile_lock.release()
+                if timings is not None:
+                    timings["callback"] = timings.get("callback", 0.0) + duration
+                self._record(name, duration, timings or {}, profile)
+
+        return _timed
+
+    def _record(self, name: str, duration: float, timings: Dict[str, float], profile):
+        with self._lock:
+            stat = self.stats.setdefault(name, {"calls": 0, "total": 0.0, "max": 0.0})
+            stat["calls"] += 1
+            stat["total"] += duration
+            stat["max"] = max(stat["max"], duration)
+            for p in PHASES:
+                stat[p] = stat.get(p, 0.0) + timings.get(p, 0.0)
+            if profile is None:
+                return
+            entry = (duration, next(self._sequence), name, profile)
+            if len(self._slowest) < self.top_n:
+                heapq.heappush(self._slowest, entry)
+            elif duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def report(self) -> List[Dict]:
+        """ Returns the stats as a list of dicts, slowest callback (by total time) first """
+        with self._lock:
+            rows = [{"callback": name, **stat} for name, stat in self.stats.items()]
+        return sorted(rows, key=lambda r: r["total"], reverse=True)
+
+    def dump_profiles(self, directory) -> List[Path]:
+        """ Saves the profiles of the slowest calls as .prof files
+
+        Args:
+            directory: folder to save the files in, created if it does not exist
+
+        Returns:
+            paths (List[Path]): the saved files, slowest first
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        paths = []
+        for rank, (duration, _, name, profile) in enumerate(slowest, start=1):
+            path = directory.joinpath(f"{rank:02d}-{name}-{duration * 1000:.0f}ms.prof")
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+
+def _server_timing(timings: Dict[str, float]) -> str:
+    """ Formats the timings as a Server-Timing header value, durations are in milliseconds """
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def instrument(app, top_n: int = 0, profile_dir: Optional[str] = None) -> CallbackProfiler:
+    """ Wraps every callback registered on the Dash app so that it is timed
+
+    Must be called after all the callbacks have been registered.
+
+    Args:
+        app (dash.Dash): the Dash app
+        top_n (int): number of the slowest callback calls to keep cProfile profiles for
+        profile_dir (str): folder to save the profiles to when the app stops
+
+    Returns:
+        profiler (CallbackProfiler): the profiler holding the collected stats
+    """
+    profiler = CallbackProfiler(top_n=top_n)
+    for cb in app.callback_map.values():
+        if "callback" not in cb:
+            continue  # clientside callbacks run in the browser, there is nothing to time here
+        func = cb["callback"]
+        cb["callback"] = profiler.wrap(func.__name__, func)
+
+    # Dash serializes the callback output inside the registered callback, so time its JSON encoder
+    if not getattr(dash_callback.to_json, "_paralympics_timed", False):
+        to_json = dash_callback.to_json
+
+        def _timed_to_json(obj):
+            with phase("serialize"):
+                return to_json(obj)
+
+        _timed_to_json._paralympics_timed = True
+        dash_callback.to_json = _timed_to_json
+
+    @app.server.before_request
+    def _start_timing():
+        if flask.request.path.endswith("_dash-update-component"):
+            flask.g.paralympics_timings_token = _timings.set({})
+
+    @app.server.after_request
+    def _add_server_timing(response):
+        token = flask.g.pop("paralympics_timings_token", None)
+        if token is not None:
+            timings = _timings.get()
+            _timings.reset(token)
+            if timings:
+                response.headers.add("Server-Timing", _server_timing(timings))
+        return response
+
+    if profile_dir:
+        atexit.register(profiler.dump_profiles, profile_dir)
+    app.profiler = profiler
+    return profiler
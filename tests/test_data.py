@@ -0,0 +1,180 @@
+""" Tests of the database functions in data.py, run against a copy of paralympics.db """
+import shutil
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from data import data as data_module
+from data.data import ParalympicsData, load_seed_files
+
+DATABASE_FILE = Path(data_module.__file__).parent.joinpath("paralympics.db")
+
+
+@pytest.fixture(name="database_file")
+def fixture_database_file(tmp_path) -> Path:
+    """ Returns the path to a copy of paralympics.db, so the tests can change it """
+    database_file = tmp_path / "paralympics.db"
+    shutil.copy(DATABASE_FILE, database_file)
+    return database_file
+
+
+def count_rows(database_file: Path, table_name: str) -> int:
+    """ Returns the number of rows in a table """
+    with sqlite3.connect(database_file) as conn:
+        return conn.execute(f"SELECT count(*) FROM '{table_name}'").fetchone()[0]
+
+
+# --- load_seed_files ---
+
+def test_seed_files_can_be_loaded_again(database_file):
+    """ The quiz data is already in the database, so loading it again adds nothing """
+    data_dir = DATABASE_FILE.parent
+    seed_files = [data_dir / "question.sql", data_dir / "response.sql"]
+    before = count_rows(database_file, "response")
+
+    results = load_seed_files(seed_files, database_file)
+
+    assert results["question"] == {"rows": 4, "inserted": 0, "skipped": 4}
+    assert results["response"] == {"rows": before, "inserted": 0, "skipped": before}
+    assert count_rows(database_file, "response") == before
+
+
+def test_seed_files_ignore_or_update_existing_rows(database_file, tmp_path):
+    """ Rows that already exist are skipped, or overwritten with on_conflict="update" """
+    seed_file = tmp_path / "question.csv"
+    seed_file.write_text("id,question_text\n1,Changed question\n100,New question\n")
+
+    results = load_seed_files([seed_file], database_file)
+    assert results["question"] == {"rows": 2, "inserted": 1, "skipped": 1}
+
+    results = load_seed_files([seed_file], database_file, on_conflict="update")
+    assert results["question"] == {"rows": 2, "inserted": 0, "updated": 2}
+    data = ParalympicsData(database_file=database_file)
+    assert data.get_row_by_id("question", 1)["question_text"] == "Changed question"
+
+
+def test_seed_files_skip_empty_csv(database_file, tmp_path):
+    """ An empty .csv file has no column names or rows, so nothing is loaded from it """
+    seed_file = tmp_path / "question.csv"
+    seed_file.write_text("")
+
+    assert not load_seed_files([seed_file], database_file)
+
+
+def test_seed_files_with_autoincrement_table(database_file, tmp_path):
+    """ Loading .sql seed files works when the database has a table using AUTOINCREMENT """
+    with sqlite3.connect(database_file) as conn:
+        conn.execute("CREATE TABLE note (id INTEGER PRIMARY KEY AUTOINCREMENT, note_text TEXT)")
+        conn.execute("INSERT INTO note (note_text) VALUES ('first')")
+    seed_file = tmp_path / "note.sql"
+    seed_file.write_text("INSERT INTO note (id, note_text) VALUES (5, 'second');")
+
+    results = load_seed_files([seed_file], database_file)
+
+    assert results == {"note": {"rows": 1, "inserted": 1, "skipped": 0}}
+    with sqlite3.connect(database_file) as conn:
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'note'").fetchone()
+    assert seq == (5,)
+
+
+def test_seed_files_are_all_loaded_or_none(database_file, tmp_path):
+    """ If a seed file can't be loaded, the rows from the other files are not kept either """
+    good_file = tmp_path / "question.csv"
+    good_file.write_text("id,question_text\n100,New question\n")
+    bad_file = tmp_path / "no_such_table.csv"
+    bad_file.write_text("id\n1\n")
+
+    with pytest.raises(ValueError):
+        load_seed_files([good_file, bad_file], database_file)
+    assert count_rows(database_file, "question") == 4
+
+
+# --- get_rows_by_ids ---
+
+@pytest.fixture(name="data")
+def fixture_data(database_file) -> ParalympicsData:
+    """ Returns a ParalympicsData that uses a copy of paralympics.db """
+    return ParalympicsData(database_file=database_file)
+
+
+def test_rows_by_ids_are_in_the_order_of_the_ids(data):
+    """ The rows are returned in the order of the ids, not the order of the table """
+    result = data.get_rows_by_ids("games", [3, 1, 2])
+
+    assert [row["id"] for row in result["rows"]] == [3, 1, 2]
+    assert result["rows"][1] == data.get_row_by_id("games", 1)
+    assert result["missing"] == []
+
+
+def test_rows_by_ids_ignore_duplicates(data):
+    """ An id given more than once returns its row once """
+    result = data.get_rows_by_ids("games", [2, 1, 2, 2])
+
+    assert [row["id"] for row in result["rows"]] == [2, 1]
+
+
+def test_rows_by_ids_report_missing_ids(data):
+    """ Ids without a row are listed in "missing", in the order they were given """
+    result = data.get_rows_by_ids("games", [1, 9999, 2, 8888])
+
+    assert [row["id"] for row in result["rows"]] == [1, 2]
+    assert result["missing"] == [9999, 8888]
+
+
+def test_rows_by_ids_are_read_in_chunks(monkeypatch, data):
+    """ More ids than IDS_PER_QUERY are read with several queries, with the same result """
+    ids = list(range(35, 0, -1)) + [9999]
+    monkeypatch.setattr(data_module, "IDS_PER_QUERY", 4)
+
+    result = data.get_rows_by_ids("games", ids)
+
+    assert [row["id"] for row in result["rows"]] == ids[:-1]
+    assert result["missing"] == [9999]
+
+
+# --- expand ---
+
+def test_expand_foreign_key_gives_one_row(data):
+    """ host.country_id refers to country, so each host has one country """
+    host = data.get_row_by_id("host", 1, expand="country")
+
+    assert host["country"] == data.get_row_by_id("country", host["country_id"])
+
+
+def test_expand_referring_table_gives_a_list(data):
+    """ games_host.games_id refers to games, so each games has a list of games_host rows """
+    games = data.get_table_as_json("games", expand="games_host,games_team")
+
+    for row in games:
+        assert isinstance(row["games_host"], list)
+        assert all(link["games_id"] == row["id"] for link in row["games_host"])
+    assert sum(len(row["games_host"]) for row in games) == len(data.get_table_as_json("games_host"))
+    assert any(row["games_team"] == [] for row in games)
+
+
+def test_expand_nested_relations(data):
+    """ Dots expand the relations of the related rows """
+    row = data.get_rows_by_ids("games", [1], expand="games_host.host.country")["rows"][0]
+
+    host = row["games_host"][0]["host"]
+    assert host["place_name"] == "Rome"
+    assert host["country"]["country_name"] == "Italy"
+    assert data.expand_tables("games", "games_host.host.country") == [
+        "games", "games_host", "host", "country"]
+
+
+def test_expand_depth_is_limited(data):
+    """ More than MAX_EXPAND_DEPTH levels is an error, so queries can't grow without limit """
+    path = ".".join(["games_host", "host", "games_host", "host"][:data_module.MAX_EXPAND_DEPTH + 1])
+
+    with pytest.raises(ValueError, match="at most"):
+        data.get_row_by_id("games", 1, expand=path)
+
+
+def test_expand_unknown_relation(data):
+    """ Names that aren't relations of the table are an error, which the API returns as a 400 """
+    with pytest.raises(ValueError, match="relations of games are"):
+        data.get_table_as_json("games", expand="country")
+    with pytest.raises(ValueError, match="relations of host are"):
+        data.expand_tables("games", "games_host.host.games")